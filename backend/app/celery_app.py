@@ -0,0 +1,59 @@
+"""Cola de tareas opcional respaldada por Redis (Celery).
+
+El worker clásico (services/worker.py) sondea la tabla sat_jobs cada 10 s;
+con un broker los workers bloquean en BRPOP y el despacho de un job baja de
+segundos a milisegundos, sin el SELECT periódico por worker contra Supabase.
+
+Es opcional: si Celery no está instalado o no hay REDIS_URL definido,
+`celery_app` queda en None y el flujo de polling sigue funcionando igual.
+
+Cada SatKind tiene su propia cola para poder dimensionar los pools por tipo
+de carga: recibidos es I/O-bound (muchos polls SOAP pequeños) y tolera alta
+concurrencia; emitidos carga más CPU en parseo/render de XML.
+
+Arranque de workers (uno por cola, pools acordes a la carga):
+    celery -A app.celery_app worker -Q sat_recibidos -P gevent -c 100
+    celery -A app.celery_app worker -Q sat_emitidos -P prefork -c $(nproc)
+    celery -A app.celery_app worker -Q sat_sync            # cola genérica
+"""
+import os
+
+try:
+    from celery import Celery  # type: ignore
+    _CELERY_OK = True
+except Exception:  # pragma: no cover
+    Celery = None  # type: ignore
+    _CELERY_OK = False
+
+REDIS_URL = os.environ.get('REDIS_URL')
+
+celery_app = None
+if _CELERY_OK and REDIS_URL:
+    celery_app = Celery('sat', broker=REDIS_URL, backend=REDIS_URL)
+    celery_app.conf.update(
+        # acks_late + reject: si un worker muere a media descarga, el job vuelve a la cola
+        task_acks_late=True,
+        task_reject_on_worker_lost=True,
+        task_default_queue='sat_sync',
+        # El visibility timeout de Redis (1 h por default) redelivery-a los
+        # syncs largos y los procesa dos veces; se sube por encima del job
+        # más largo esperado. prefetch=1 evita que un job lento acapare
+        # tareas reservadas y mate la latencia de los rápidos.
+        broker_transport_options={'visibility_timeout': 6 * 3600, 'priority_steps': [0, 3, 6, 9]},
+        worker_prefetch_multiplier=1,
+        result_expires=24 * 3600,
+        # Backfills encolan cientos de tareas de golpe: comprimir payloads
+        # y resultados reduce el tráfico y la memoria del broker
+        task_compression='gzip',
+        result_compression='gzip',
+    )
+    try:
+        from kombu import Queue, Exchange  # type: ignore
+        _sat_exchange = Exchange('sat')
+        celery_app.conf.task_queues = (
+            Queue('sat_sync', _sat_exchange, routing_key='sat_sync'),
+            Queue('sat_recibidos', _sat_exchange, routing_key='sat_recibidos'),
+            Queue('sat_emitidos', _sat_exchange, routing_key='sat_emitidos'),
+        )
+    except Exception:  # pragma: no cover
+        pass
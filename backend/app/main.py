@@ -4,33 +4,34 @@ from .routers import sat, reports
 from dotenv import load_dotenv
 import os
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
+import time
 from .supabase_client import get_supabase
 from .services.sat_sat20 import XMLSEC_AVAILABLE, WSDL_AUTENTICACION, WSDL_SOLICITUD
 
-# Cargar variables de entorno desde backend/.env de forma robusta (independiente del CWD)
+# Cargar variables de entorno desde backend/.env de forma robusta (independiente del CWD).
+# Una sola pasada de parseo por boot: si backend/.env no existe, caemos al .env del CWD.
 _ENV_PATH = (Path(__file__).resolve().parents[1] / '.env')
-# Primero intentamos cargar el .env específico del backend
-load_dotenv(dotenv_path=_ENV_PATH, override=False)
-# Luego permitimos además variables del CWD si el proceso se lanzó ahí
-load_dotenv(override=False)
+load_dotenv(dotenv_path=(_ENV_PATH if _ENV_PATH.exists() else None), override=False)
 
 # Nota: Cambio no funcional para forzar recarga al ajustar .env
 app = FastAPI(title="Fiscal-IA Backend")
 # Note: Reloading this file forces re-reading backend/.env via python-dotenv
 
 # Configuración de CORS para permitir que el frontend se comunique con esta API
-# Configuración CORS dinámica a partir de CORS_ORIGINS (lista separada por comas)
+# Configuración CORS dinámica a partir de CORS_ORIGINS (lista separada por comas).
+# Se congela en una tupla una sola vez al importar para que el camino ASGI por request
+# no haga splits ni asigne listas nuevas (CORSMiddleware de Starlette ya es ASGI puro).
 _cors_env = os.environ.get('CORS_ORIGINS', '*')
-_cors_list = [c.strip() for c in _cors_env.split(',') if c.strip()]
-if not _cors_list:
-    _cors_list = ['*']
-allow_origins = ['*'] if _cors_list == ['*'] else _cors_list
+_ALLOW_ORIGINS = tuple(c.strip() for c in _cors_env.split(',') if c.strip()) or ('*',)
+# Con wildcard los navegadores ignoran credenciales de todas formas; desactivarlas
+# deja que Starlette tome su rama rápida de '*'.
+_ALLOW_CREDENTIALS = _ALLOW_ORIGINS != ('*',)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=allow_origins,
-    allow_credentials=True,
+    allow_origins=_ALLOW_ORIGINS,
+    allow_credentials=_ALLOW_CREDENTIALS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -45,27 +46,35 @@ import hashlib, inspect
 def _hash_file(path: str) -> str:
     try:
         with open(path,'rb') as fh:
-            return hashlib.sha1(fh.read()).hexdigest()[:12]
+            # file_digest (Py3.11+) alimenta OpenSSL por bloques: usa SHA-NI/ARMv8-crypto
+            # sin materializar el archivo completo en memoria
+            if hasattr(hashlib, 'file_digest'):
+                return hashlib.file_digest(fh, 'sha1').hexdigest()[:12]
+            h = hashlib.sha1()
+            for chunk in iter(lambda: fh.read(65536), b''):
+                h.update(chunk)
+            return h.hexdigest()[:12]
     except Exception:
         return 'unavailable'
 
 @app.on_event("startup")
 async def _log_loaded_modules():  # pragma: no cover
+    # Calculamos el hash una sola vez por proceso; /build-info sirve el valor cacheado
     try:
         sat_path = inspect.getfile(sat)
-        print(f"[build-info] sat.py path={sat_path} sha1={_hash_file(sat_path)}")
+        app.state.sat_path = sat_path
+        app.state.sat_sha1 = _hash_file(sat_path)
+        print(f"[build-info] sat.py path={sat_path} sha1={app.state.sat_sha1}")
     except Exception as e:
+        app.state.sat_path = None
+        app.state.sat_sha1 = None
         print(f"[build-info][error] {e}")
 
 @app.get("/build-info")
 def build_info():  # pragma: no cover
-    try:
-        sat_path = inspect.getfile(sat)
-    except Exception:
-        sat_path = None
     return {
-        'sat_file': sat_path,
-        'sat_sha1_12': _hash_file(sat_path) if sat_path else None,
+        'sat_file': getattr(app.state, 'sat_path', None),
+        'sat_sha1_12': getattr(app.state, 'sat_sha1', None),
     }
 
 @app.get("/health")
@@ -101,10 +110,18 @@ def diag():
     return data
 
 
+# Timestamp formateado cacheado con granularidad de 1 segundo: los probes de salud
+# que golpean /diag/time en ráfaga comparten el mismo isoformat()
+_DIAG_TIME_CACHE: list = [0, '']
+
+
 @app.get("/diag/time")
 def diag_time():
     """
     Endpoint para verificar la hora del servidor (UTC), útil para depurar problemas
     de autenticación con el SAT que son sensibles al tiempo.
     """
-    return { 'utc': datetime.utcnow().isoformat() }
+    now = int(time.time())
+    if now != _DIAG_TIME_CACHE[0]:
+        _DIAG_TIME_CACHE[:] = [now, datetime.now(timezone.utc).isoformat()]
+    return { 'utc': _DIAG_TIME_CACHE[1] }
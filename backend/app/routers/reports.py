@@ -1,13 +1,34 @@
 from fastapi import APIRouter, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict
 from ..supabase_client import get_supabase
+from cachetools import TTLCache
+from collections import defaultdict
 import os
 
-router = APIRouter()
+try:  # asyncpg es opcional: habilita el camino async directo a Postgres si hay SUPABASE_DB_URL
+    import asyncpg  # type: ignore
+    _ASYNCPG_OK = True
+except Exception:  # pragma: no cover
+    _ASYNCPG_OK = False
+
+_PG_POOL = None
+
+try:  # pandas/numpy aceleran la agregación mensual; si faltan caemos al bucle puro
+    import pandas as pd  # type: ignore
+    import numpy as np  # type: ignore
+    _PANDAS_OK = True
+except Exception:  # pragma: no cover
+    _PANDAS_OK = False
+
+router = APIRouter(default_response_class=ORJSONResponse)
 
 
 class MonthlyRow(BaseModel):
+    # Documenta la forma de la respuesta de /monthly; el handler devuelve dicts planos
+    # (sin pasada de validación Pydantic) con exactamente estas claves.
     periodo: str  # YYYY-MM
     ingresos: float
     egresos: float
@@ -18,93 +39,388 @@ class MonthlyRow(BaseModel):
     isr: float
 
 
+# RFC y régimen cambian casi nunca; cachearlos evita dos round-trips por request
+_META_CACHE: TTLCache = TTLCache(maxsize=1024, ttl=300)
+
+# Respuestas completas de /monthly: los dashboards la consultan en polling y la mayoría
+# de las veces no llegó ningún CFDI nuevo. Clave: (company_id, fecha del CFDI más reciente).
+_MONTHLY_CACHE: TTLCache = TTLCache(maxsize=512, ttl=60)
+
+
+def _latest_cfdi_marker(sb, company_id: str) -> Optional[str]:
+    """Fecha del CFDI más reciente de la compañía; sirve como versión barata del dataset."""
+    try:
+        res = sb.table('cfdi').select('fecha').eq('company_id', company_id).order('fecha', desc=True).limit(1).execute()
+        data = getattr(res, 'data', None) or []
+        return str(data[0].get('fecha')) if data else ''
+    except Exception:
+        return None
+
+
+# Tasas configurables, leídas una sola vez al importar (el entorno no cambia en caliente)
+_ISR_RATES = {
+    'resico': float(os.environ.get('ISR_RATE_RESICO', '0.0125')),
+    'default': float(os.environ.get('ISR_RATE_DEFAULT', '0.30')),
+}
+
+
 def _get_company_and_regime(sb, company_id: str) -> Dict[str, Optional[str]]:
-    comp = sb.table('companies').select('rfc, owner_id').eq('id', company_id).maybe_single().execute()
-    if not getattr(comp, 'data', None):
-        raise RuntimeError('Compañía no encontrada')
-    company_rfc = (comp.data.get('rfc') or '').upper()
-    owner_id = comp.data.get('owner_id')
-    regime = None
-    if owner_id:
-        prof = sb.table('profiles').select('regime').eq('user_id', owner_id).maybe_single().execute()
-        regime = (getattr(prof, 'data', {}) or {}).get('regime')
-    return { 'rfc': company_rfc, 'regime': regime }
-
-
-@router.get('/monthly', response_model=List[MonthlyRow])
-def monthly_summary(company_id: str = Query(..., description="UUID de la compañía"), persist: bool = False):
+    cached = _META_CACHE.get(company_id)
+    if cached is not None:
+        return cached
+    # Un solo round-trip: PostgREST resuelve el join companies->profiles como recurso embebido
+    try:
+        comp = sb.table('companies').select('rfc, owner:profiles!owner_id(regime)').eq('id', company_id).maybe_single().execute()
+        data = getattr(comp, 'data', None)
+        if not data:
+            raise RuntimeError('Compañía no encontrada')
+        company_rfc = (data.get('rfc') or '').upper()
+        owner = data.get('owner')
+        regime = owner.get('regime') if isinstance(owner, dict) else None
+    except RuntimeError:
+        raise
+    except Exception:
+        # Fallback a dos consultas si el FK del embed no existe en este esquema
+        comp = sb.table('companies').select('rfc, owner_id').eq('id', company_id).maybe_single().execute()
+        if not getattr(comp, 'data', None):
+            raise RuntimeError('Compañía no encontrada')
+        company_rfc = (comp.data.get('rfc') or '').upper()
+        owner_id = comp.data.get('owner_id')
+        regime = None
+        if owner_id:
+            prof = sb.table('profiles').select('regime').eq('user_id', owner_id).maybe_single().execute()
+            regime = (getattr(prof, 'data', {}) or {}).get('regime')
+    meta = { 'rfc': company_rfc, 'regime': regime }
+    _META_CACHE[company_id] = meta
+    return meta
+
+
+def _aggregate_rows_pandas(rows: List[dict], company_rfc: str) -> Dict[str, Dict[str, float]]:
+    """Agrega con pandas/NumPy: el bucle por fila se ejecuta en C en lugar del intérprete."""
+    df = pd.DataFrame(rows, columns=['fecha', 'total', 'impuestos', 'emisor_rfc', 'receptor_rfc'])
+    df['ym'] = df['fecha'].astype(str).str.slice(0, 7)
+    df = df[df['ym'].str.len() == 7]
+    if df.empty:
+        return {}
+    total = pd.to_numeric(df['total'], errors='coerce').fillna(0.0)
+    iva = pd.to_numeric(df['impuestos'], errors='coerce')
+    # Aproximación si no hay desglose de impuestos (misma regla que el bucle puro)
+    iva = iva.where(~iva.isna(), np.round(total * 0.16, 2))
+    # Los RFC ya viven en mayúsculas en la base (cfdi_rfc_upper_check); comparación directa
+    es_emisor = df['emisor_rfc'] == company_rfc
+    es_receptor = df['receptor_rfc'] == company_rfc
+    grouped = pd.DataFrame({
+        'ingresos': total.where(es_emisor, 0.0),
+        'egresos': total.where(es_receptor, 0.0),
+        'iva_cobrado': iva.where(es_emisor, 0.0),
+        'iva_acreditable': iva.where(es_receptor, 0.0),
+    }).groupby(df['ym']).sum()
+    # El frame resultante es pequeño (un renglón por mes); iterarlo ya no es costoso
+    return {
+        str(ym): {
+            'ingresos': float(v['ingresos']),
+            'egresos': float(v['egresos']),
+            'iva_cobrado': float(v['iva_cobrado']),
+            'iva_acreditable': float(v['iva_acreditable']),
+        }
+        for ym, v in grouped.iterrows()
+    }
+
+
+def _aggregate_rows_python(rows: List[dict], company_rfc: str) -> Dict[str, Dict[str, float]]:
+    """Fallback puro-Python cuando pandas no está instalado.
+
+    Usa cuatro mapas paralelos (SoA) en lugar de un dict de 4 claves por mes:
+    una sola resolución de bucket + suma de float por métrica y menos presión de GC.
+    """
+    ingresos: Dict[str, float] = defaultdict(float)
+    egresos: Dict[str, float] = defaultdict(float)
+    iva_c: Dict[str, float] = defaultdict(float)
+    iva_a: Dict[str, float] = defaultdict(float)
+    # Ligar builtins calientes a locales: LOAD_FAST en lugar de LOAD_GLOBAL por iteración
+    _float = float
+    _round = round
+    _str = str
+    for r in rows:
+        rget = r.get
+        fecha = (rget('fecha') or '')
+        ym = _str(fecha)[:7]
+        if len(ym) != 7:
+            continue
+        total = _float(rget('total') or 0)
+        iva = rget('impuestos')
+        if iva is None:
+            iva = _round(total * 0.16, 2)  # aproximación si no hay desglose
+        else:
+            iva = _float(iva or 0)
+
+        # Los RFC ya están normalizados a mayúsculas al ingresar
+        emisor = rget('emisor_rfc') or ''
+        receptor = rget('receptor_rfc') or ''
+        if emisor == company_rfc:
+            ingresos[ym] += total
+            iva_c[ym] += iva
+        if receptor == company_rfc:
+            egresos[ym] += total
+            iva_a[ym] += iva
+    return {
+        ym: {
+            'ingresos': ingresos[ym],
+            'egresos': egresos[ym],
+            'iva_cobrado': iva_c[ym],
+            'iva_acreditable': iva_a[ym],
+        }
+        for ym in (ingresos.keys() | egresos.keys())
+    }
+
+
+def _aggregate_rows(rows: List[dict], company_rfc: str) -> Dict[str, Dict[str, float]]:
+    if _PANDAS_OK and rows:
+        return _aggregate_rows_pandas(rows, company_rfc)
+    return _aggregate_rows_python(rows, company_rfc)
+
+
+# Tope del Range pedido por página. El límite real lo pone el max-rows del
+# servidor PostgREST (1000 por default en Supabase), que aplica aunque el
+# cliente mande un Range mayor: por eso el loop avanza por len(chunk) y no
+# asume que una página "corta" sea la última.
+_CFDI_PAGE_SIZE = 1000
+
+
+def _merge_agg(dst: Dict[str, Dict[str, float]], src: Dict[str, Dict[str, float]]) -> None:
+    """Suma los buckets mensuales de src sobre dst (add-reduce entre páginas)."""
+    for ym, vals in src.items():
+        bucket = dst.setdefault(ym, { 'ingresos': 0.0, 'egresos': 0.0, 'iva_cobrado': 0.0, 'iva_acreditable': 0.0 })
+        for k, v in vals.items():
+            bucket[k] += v
+
+
+def _fetch_and_aggregate(sb, company_id: str, company_rfc: str) -> Dict[str, Dict[str, float]]:
+    """Trae los CFDI por páginas con .range() y agrega cada página.
+
+    Supabase-py limita las respuestas a ~1000 filas por defecto; sin paginación el
+    resultado se truncaba silenciosamente para compañías grandes. Además el pico de
+    memoria queda acotado a una página en lugar de todo el resultado.
+    """
+    agg: Dict[str, Dict[str, float]] = {}
+    offset = 0
+    while True:
+        res = (
+            sb.table('cfdi')
+            .select('fecha,total,impuestos,emisor_rfc,receptor_rfc')
+            .eq('company_id', company_id)
+            # Orden estable entre páginas: sin ORDER BY, Postgres no garantiza
+            # el mismo orden en cada LIMIT/OFFSET y las páginas pueden
+            # solaparse o saltarse filas (CFDI contados doble o de menos).
+            # uuid desempata fechas repetidas.
+            .order('fecha')
+            .order('uuid')
+            .range(offset, offset + _CFDI_PAGE_SIZE - 1)
+            .execute()
+        )
+        chunk = getattr(res, 'data', []) or []
+        if not chunk:
+            break
+        _merge_agg(agg, _aggregate_rows(chunk, company_rfc))
+        # Avanzar por lo realmente recibido: el servidor puede recortar la
+        # página por debajo de lo pedido (max-rows), así que una página corta
+        # NO implica fin de datos; sólo la página vacía termina el loop.
+        offset += len(chunk)
+    return agg
+
+
+def _aggregate_via_rpc(sb, company_id: str) -> Optional[Dict[str, Dict[str, float]]]:
+    """Intenta agregar en Postgres vía rpc('monthly_summary'): el GROUP BY corre en la base
+    y sólo viajan ~N_meses filas en lugar de todos los CFDI.
+
+    Devuelve None si la función SQL no existe aún (migración no aplicada) para que el
+    caller use la agregación en Python como fallback.
+    """
+    try:
+        res = sb.rpc('monthly_summary', {'p_company': company_id}).execute()
+    except Exception:
+        return None
+    rows = getattr(res, 'data', None)
+    if not isinstance(rows, list):
+        return None
+    return {
+        str(r.get('ym')): {
+            'ingresos': float(r.get('ingresos') or 0),
+            'egresos': float(r.get('egresos') or 0),
+            'iva_cobrado': float(r.get('iva_cobrado') or 0),
+            'iva_acreditable': float(r.get('iva_acreditable') or 0),
+        }
+        for r in rows
+        if r.get('ym')
+    }
+
+
+def _build_monthly_rows(agg: Dict[str, Dict[str, float]], isr_rate: float) -> List[dict]:
+    # Dicts planos en lugar de instancias MonthlyRow: el cálculo es interno/confiable,
+    # así evitamos pagar validación Pydantic además de la serialización
+    out: List[dict] = []
+    for ym in sorted(agg.keys()):
+        v = agg[ym]
+        isr_base = max(v['ingresos'] - v['egresos'], 0.0)
+        out.append({
+            'periodo': ym,
+            'ingresos': round(v['ingresos'], 2),
+            'egresos': round(v['egresos'], 2),
+            'iva_cobrado': round(v['iva_cobrado'], 2),
+            'iva_acreditable': round(v['iva_acreditable'], 2),
+            'iva_a_pagar': round(v['iva_cobrado'] - v['iva_acreditable'], 2),
+            'isr_base': round(isr_base, 2),
+            'isr': round(isr_base * isr_rate, 2),
+        })
+    return out
+
+
+async def _get_pg_pool():
+    """Pool asyncpg perezoso contra Postgres directo (requiere SUPABASE_DB_URL).
+
+    Devuelve None si asyncpg no está instalado o no hay DSN configurado; en ese caso
+    el endpoint usa el camino síncrono vía PostgREST en el threadpool.
+    """
+    global _PG_POOL
+    dsn = os.environ.get('SUPABASE_DB_URL')
+    if not (_ASYNCPG_OK and dsn):
+        return None
+    if _PG_POOL is None:
+        _PG_POOL = await asyncpg.create_pool(dsn, min_size=1, max_size=10)
+    return _PG_POOL
+
+
+async def _monthly_via_asyncpg(company_id: str) -> Optional[List[dict]]:
+    """Camino rápido async: una consulta de metadatos + la función monthly_summary,
+    sin bloquear el event loop ni pasar por el hop JSON de PostgREST."""
+    pool = await _get_pg_pool()
+    if pool is None:
+        return None
     try:
-        sb = get_supabase()
-        meta = _get_company_and_regime(sb, company_id)
-        company_rfc = meta['rfc']
-        regime = (meta['regime'] or '').lower()
-
-        # Tasas configurables
-        isr_rate_resico = float(os.environ.get('ISR_RATE_RESICO', '0.0125'))
-        isr_rate_default = float(os.environ.get('ISR_RATE_DEFAULT', '0.30'))
-        isr_rate = isr_rate_resico if ('resico' in regime) else isr_rate_default
-
-        res = sb.table('cfdi').select('fecha,total,impuestos,emisor_rfc,receptor_rfc').eq('company_id', company_id).execute()
-        rows = getattr(res, 'data', []) or []
-        agg: Dict[str, Dict[str, float]] = {}
-
-        for r in rows:
-            fecha = (r.get('fecha') or '')
-            ym = str(fecha)[:7]
-            if len(ym) != 7:
-                continue
-            bucket = agg.setdefault(ym, { 'ingresos': 0.0, 'egresos': 0.0, 'iva_cobrado': 0.0, 'iva_acreditable': 0.0 })
-            total = float(r.get('total') or 0)
-            iva = r.get('impuestos')
-            if iva is None:
-                iva = round(total * 0.16, 2)  # aproximación si no hay desglose
-            else:
-                iva = float(iva or 0)
-
-            emisor = (r.get('emisor_rfc') or '').upper()
-            receptor = (r.get('receptor_rfc') or '').upper()
-            if emisor == company_rfc:
-                bucket['ingresos'] += total
-                bucket['iva_cobrado'] += iva
-            if receptor == company_rfc:
-                bucket['egresos'] += total
-                bucket['iva_acreditable'] += iva
-
-        out: List[MonthlyRow] = []
-        for ym in sorted(agg.keys()):
-            v = agg[ym]
-            isr_base = max(v['ingresos'] - v['egresos'], 0.0)
-            isr = round(isr_base * isr_rate, 2)
-            iva_a_pagar = round(v['iva_cobrado'] - v['iva_acreditable'], 2)
-            row = MonthlyRow(
-                periodo=ym,
-                ingresos=round(v['ingresos'], 2),
-                egresos=round(v['egresos'], 2),
-                iva_cobrado=round(v['iva_cobrado'], 2),
-                iva_acreditable=round(v['iva_acreditable'], 2),
-                iva_a_pagar=iva_a_pagar,
-                isr_base=round(isr_base, 2),
-                isr=isr,
+        async with pool.acquire() as con:
+            meta = await con.fetchrow(
+                'select c.rfc, p.regime from companies c '
+                'left join profiles p on p.user_id = c.owner_id where c.id = $1::uuid',
+                company_id,
             )
-            out.append(row)
-
-        if persist:
-            # Guardar en taxes_monthly (upsert-like: update si existe)
-            for row in out:
-                rec = {
-                    'company_id': company_id,
-                    'periodo': f"{row.periodo}-01",
-                    'isr_base': row.isr_base,
-                    'isr': row.isr,
-                    'iva_cobrado': row.iva_cobrado,
-                    'iva_acreditable': row.iva_acreditable,
-                    'iva_a_pagar': row.iva_a_pagar,
-                }
-                try:
-                    sb.table('taxes_monthly').insert(rec).execute()
-                except Exception:
-                    sb.table('taxes_monthly').update(rec).eq('company_id', company_id).eq('periodo', rec['periodo']).execute()
-
-        return out
+            if meta is None:
+                raise RuntimeError('Compañía no encontrada')
+            recs = await con.fetch('select * from monthly_summary($1::uuid)', company_id)
+    except RuntimeError:
+        raise
+    except Exception:
+        # Función/DSN no disponibles: dejar que el caller use el camino síncrono
+        return None
+    regime = (meta['regime'] or '').lower()
+    isr_rate = _ISR_RATES['resico'] if ('resico' in regime) else _ISR_RATES['default']
+    agg = {
+        str(r['ym']): {
+            'ingresos': float(r['ingresos'] or 0),
+            'egresos': float(r['egresos'] or 0),
+            'iva_cobrado': float(r['iva_cobrado'] or 0),
+            'iva_acreditable': float(r['iva_acreditable'] or 0),
+        }
+        for r in recs
+        if r['ym']
+    }
+    return _build_monthly_rows(agg, isr_rate)
+
+
+def _monthly_from_materialized(sb, company_id: str, isr_rate: float) -> Optional[List[dict]]:
+    """Lee los agregados precalculados de taxes_monthly (mantenidos por trigger sobre cfdi).
+
+    Devuelve None si la migración del trigger no está aplicada (columna ingresos ausente
+    o tabla vacía) para que el caller recalcule desde los CFDI crudos.
+    """
+    try:
+        res = (
+            sb.table('taxes_monthly')
+            .select('periodo,ingresos,egresos,iva_cobrado,iva_acreditable')
+            .eq('company_id', company_id)
+            .order('periodo')
+            .execute()
+        )
+    except Exception:
+        return None
+    rows = getattr(res, 'data', None)
+    if not rows or rows[0].get('ingresos') is None:
+        return None
+    agg = {
+        str(r['periodo'])[:7]: {
+            'ingresos': float(r.get('ingresos') or 0),
+            'egresos': float(r.get('egresos') or 0),
+            'iva_cobrado': float(r.get('iva_cobrado') or 0),
+            'iva_acreditable': float(r.get('iva_acreditable') or 0),
+        }
+        for r in rows
+    }
+    return _build_monthly_rows(agg, isr_rate)
+
+
+def _monthly_summary_sync(company_id: str, persist: bool, recompute: bool = False) -> List[dict]:
+    sb = get_supabase()
+    meta = _get_company_and_regime(sb, company_id)
+    company_rfc = meta['rfc']
+    regime = (meta['regime'] or '').lower()
+
+    isr_rate = _ISR_RATES['resico'] if ('resico' in regime) else _ISR_RATES['default']
+
+    # Camino materializado: taxes_monthly se mantiene vía trigger, así que una lectura
+    # de O(meses) filas basta. recompute=true fuerza el cálculo desde los CFDI crudos.
+    if not persist and not recompute:
+        mat = _monthly_from_materialized(sb, company_id, isr_rate)
+        if mat is not None:
+            return mat
+
+    # Cache de respuesta corta: sólo para lecturas (persist recalcula y escribe siempre)
+    marker = _latest_cfdi_marker(sb, company_id) if not persist else None
+    cache_key = (company_id, marker)
+    if marker is not None:
+        hit = _MONTHLY_CACHE.get(cache_key)
+        if hit is not None:
+            return hit
+
+    # Preferimos agregar en Postgres (RPC); si la función no está desplegada, agregamos aquí
+    agg = _aggregate_via_rpc(sb, company_id)
+    if agg is None:
+        agg = _fetch_and_aggregate(sb, company_id, company_rfc)
+
+    out = _build_monthly_rows(agg, isr_rate)
+
+    if persist and out:
+        # Guardar en taxes_monthly con un solo upsert batched (requiere índice único en company_id,periodo)
+        records = [
+            {
+                'company_id': company_id,
+                'periodo': f"{row['periodo']}-01",
+                'isr_base': row['isr_base'],
+                'isr': row['isr'],
+                'iva_cobrado': row['iva_cobrado'],
+                'iva_acreditable': row['iva_acreditable'],
+                'iva_a_pagar': row['iva_a_pagar'],
+            }
+            for row in out
+        ]
+        sb.table('taxes_monthly').upsert(records, on_conflict='company_id,periodo').execute()
+
+    if marker is not None:
+        _MONTHLY_CACHE[cache_key] = out
+    return out
+
+
+# ORJSONResponse: serialización C/SIMD, notablemente más rápida para arreglos de floats
+@router.get('/monthly', response_model=None, response_class=ORJSONResponse)
+async def monthly_summary(
+    company_id: str = Query(..., description="UUID de la compañía"),
+    persist: bool = False,
+    recompute: bool = Query(False, description="Fuerza recalcular desde los CFDI crudos (ignora taxes_monthly)"),
+):
+    try:
+        if not persist and not recompute:
+            rows = await _monthly_via_asyncpg(company_id)
+            if rows is not None:
+                return rows
+        # Camino síncrono (supabase-py bloqueante) fuera del event loop
+        return await run_in_threadpool(_monthly_summary_sync, company_id, persist, recompute)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
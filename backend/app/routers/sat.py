@@ -1,17 +1,54 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks, Query
+from fastapi import APIRouter, HTTPException, Query, Request
 from pydantic import BaseModel, field_validator
 from typing import Optional
-from fastapi.responses import StreamingResponse, JSONResponse, Response
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse, RedirectResponse, Response
+from fastapi.concurrency import run_in_threadpool
+from functools import lru_cache
+import asyncio
+import gzip
+import hashlib
 import os
 import io
+import re
+import time
+import httpx
+import orjson
 from ..services.sat_provider import SatProvider, SatKind
 try:  # type: ignore
     from ..services.sat_job_example import SatDownloader  # type: ignore[attr-defined]
 except Exception:  # pragma: no cover
     SatDownloader = None  # type: ignore
 from ..services.sat_sat20 import Sat20Client
+from ..supabase_client import get_supabase
+from cachetools import TTLCache
+
+# satcfdi es opcional y caro de importar (cientos de ms por el cableado de
+# XSD): se resuelve una sola vez al boot del worker, antes de que pase el
+# health check, en lugar de castigar al primer request. Los subprocesos del
+# pool de render importan su propia copia; este flag permite responder 501
+# sin pagar un intento de import dentro del handler.
+try:
+    import satcfdi  # noqa: F401  # type: ignore
+    _SATCFDI_AVAILABLE = True
+except Exception:  # pragma: no cover
+    _SATCFDI_AVAILABLE = False
+
+# orjson serializa los dicts grandes (list_cfdi, job-trace, test-flow) varias
+# veces más rápido que el json de stdlib y maneja datetime/UUID nativamente.
+router = APIRouter(default_response_class=ORJSONResponse)
+
+
+@lru_cache(maxsize=1)
+def _get_provider() -> SatProvider:
+    """SatProvider compartido del proceso: evita releer env y reconstruir el cliente
+    de Supabase en cada request."""
+    return SatProvider()
 
-router = APIRouter()
+
+@lru_cache(maxsize=1)
+def _get_sat20() -> Sat20Client:
+    """Sat20Client compartido (sólo guarda WSDLs y metadatos de diagnóstico)."""
+    return Sat20Client()
 
 # Debug: log when this router file is imported to verify hot-reload is using the expected path.
 try:  # pragma: no cover - sólo diagnóstico
@@ -38,11 +75,53 @@ class SatSyncRequest(BaseModel):
             raise ValueError('Formato de fecha debe ser YYYY-MM-DD')
         return v
 
-@router.post('/sync')
-def sync_cfdi(req: SatSyncRequest, background: BackgroundTasks):
+# Cola acotada de jobs: un número fijo de workers consume process_job sobre
+# threadpool. A diferencia de BackgroundTasks (un hilo por tarea, sin límite),
+# una ráfaga de /sync no agota el pool ni abre N conexiones SOAP simultáneas;
+# si la cola se llena se responde 429 como backpressure explícito.
+_JOB_QUEUE: Optional[asyncio.Queue] = None
+_JOB_WORKERS: list = []
+_JOB_WORKER_COUNT = int(os.environ.get('SAT_JOB_WORKERS', '4'))
+
+
+async def _job_worker(queue: asyncio.Queue):
+    while True:
+        fn, kwargs = await queue.get()
+        try:
+            await asyncio.to_thread(fn, **kwargs)
+        except Exception:
+            pass  # process_job deja su propio error en la fila de sat_jobs
+        finally:
+            queue.task_done()
+
+
+def _ensure_job_workers() -> asyncio.Queue:
+    """Arranque perezoso: la cola y los workers se crean en el primer /sync,
+    cuando ya existe event loop."""
+    global _JOB_QUEUE
+    if _JOB_QUEUE is None:
+        _JOB_QUEUE = asyncio.Queue(maxsize=256)
+        for _ in range(_JOB_WORKER_COUNT):
+            _JOB_WORKERS.append(asyncio.create_task(_job_worker(_JOB_QUEUE)))
+    return _JOB_QUEUE
+
+
+def _enqueue_process_job(provider: SatProvider, **kwargs) -> None:
+    queue = _ensure_job_workers()
+    try:
+        queue.put_nowait((provider.process_job, kwargs))
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=429, detail='Cola de sincronización llena; reintenta en unos segundos.')
+
+
+@router.post('/sync', status_code=202)
+async def sync_cfdi(req: SatSyncRequest):
     try:
-        provider = SatProvider()
-        job_id = provider.enqueue_sync(
+        provider = _get_provider()
+        # Insert del job fuera del event loop: en ráfagas de enqueues el hilo
+        # de la request no se serializa esperando el round-trip a Supabase.
+        job_id = await run_in_threadpool(
+            provider.enqueue_sync,
             user_id=req.user_id,
             company_id=req.company_id,
             kind=req.kind,
@@ -50,9 +129,9 @@ def sync_cfdi(req: SatSyncRequest, background: BackgroundTasks):
             date_to=req.date_to,
             tipo_solicitud=req.tipo_solicitud,
         )
-        # Procesamiento en background para no bloquear la respuesta
-        background.add_task(
-            provider.process_job,
+        # Procesamiento en background con concurrencia acotada
+        _enqueue_process_job(
+            provider,
             job_id=job_id,
             user_id=req.user_id,
             company_id=req.company_id,
@@ -63,13 +142,14 @@ def sync_cfdi(req: SatSyncRequest, background: BackgroundTasks):
             tipo_solicitud=req.tipo_solicitud,
         )
         return {"id": job_id, "status": "queued"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.get('/sync-dev')
-def sync_cfdi_dev(
-    background: BackgroundTasks,
+@router.get('/sync-dev', status_code=202)
+async def sync_cfdi_dev(
     user_id: str = Query(...),
     company_id: str = Query(...),
     kind: SatKind = SatKind.recibidos,
@@ -83,8 +163,9 @@ def sync_cfdi_dev(
     ADVERTENCIA: La passphrase via query string NO debe usarse en producción.
     """
     try:
-        provider = SatProvider()
-        job_id = provider.enqueue_sync(
+        provider = _get_provider()
+        job_id = await run_in_threadpool(
+            provider.enqueue_sync,
             user_id=user_id,
             company_id=company_id,
             kind=kind,
@@ -92,8 +173,8 @@ def sync_cfdi_dev(
             date_to=date_to,
             tipo_solicitud=tipo_solicitud,
         )
-        background.add_task(
-            provider.process_job,
+        _enqueue_process_job(
+            provider,
             job_id=job_id,
             user_id=user_id,
             company_id=company_id,
@@ -104,6 +185,54 @@ def sync_cfdi_dev(
             tipo_solicitud=tipo_solicitud,
         )
         return { 'id': job_id, 'status': 'queued', 'kind': kind, 'tipo_solicitud': tipo_solicitud }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Las rutas fijas /jobs/dlq van antes de /jobs/{job_id} para que el
+# matcher no las capture como un job_id literal.
+@router.get('/jobs/dlq')
+def list_sync_dlq(limit: int = Query(50, ge=1, le=500)):
+    """Entradas de la dead-letter queue de sincronización (Redis)."""
+    try:
+        from ..services.sat_job_example import _get_redis
+        from ..services.sat_tasks import DLQ_KEY
+        r = _get_redis()
+        if r is None:
+            raise HTTPException(status_code=501, detail='Sin Redis (REDIS_URL no configurado)')
+        items = []
+        for raw in r.lrange(DLQ_KEY, 0, limit - 1):
+            try:
+                items.append(orjson.loads(raw))
+            except Exception:
+                items.append({'raw': raw.decode('utf-8', errors='ignore')})
+        return {'items': items, 'count': len(items)}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.post('/jobs/dlq/{index}/requeue')
+def requeue_sync_dlq(index: int):
+    """Reencola la entrada `index` de la DLQ y la quita de la lista."""
+    try:
+        from ..services.sat_job_example import _get_redis
+        from ..services.sat_tasks import DLQ_KEY, run_sync_job
+        r = _get_redis()
+        if r is None or run_sync_job is None:
+            raise HTTPException(status_code=501, detail='Sin broker Celery (REDIS_URL no configurado)')
+        raw = r.lindex(DLQ_KEY, index)
+        if raw is None:
+            raise HTTPException(status_code=404, detail='Entrada DLQ no encontrada')
+        entry = orjson.loads(raw)
+        result = run_sync_job.apply_async(args=entry.get('args') or [])
+        r.lrem(DLQ_KEY, 1, raw)
+        return {'requeued': True, 'task_id': result.id, 'args': entry.get('args')}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -111,7 +240,7 @@ def sync_cfdi_dev(
 @router.get('/jobs/{job_id}')
 def get_job(job_id: str):
     try:
-        provider = SatProvider()
+        provider = _get_provider()
         job = provider.get_job(job_id)
         if not job:
             raise HTTPException(status_code=404, detail="Job no encontrado")
@@ -121,19 +250,50 @@ def get_job(job_id: str):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get('/tasks/{task_id}/status')
+def get_task_status(task_id: str):
+    """Estado de una tarea Celery leído del backend de resultados en Redis.
+
+    Para frontends que sondean progreso: un GET al meta de la tarea en Redis
+    cuesta décimas de ms frente al round-trip a Supabase de /jobs/{job_id}.
+    Requiere broker configurado (REDIS_URL); /jobs/{job_id} sigue siendo la
+    fuente de verdad persistente.
+    """
+    try:
+        from ..celery_app import celery_app
+        if celery_app is None:
+            raise HTTPException(status_code=501, detail='Sin broker Celery (REDIS_URL no configurado)')
+        result = celery_app.AsyncResult(task_id)
+        return {
+            'task_id': task_id,
+            'state': result.state,
+            'meta': result.info if isinstance(result.info, dict) else None,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Proyección del trace: se pide a PostgREST sólo estas columnas en lugar de
+# select('*') + recorte en Python (el resto de la fila puede ser pesado).
+_JOB_TRACE_KEEP = ','.join([
+    'id','status','error','note','tipo_solicitud_final','fallback_from_cfdi','request_meta','request_error',
+    'fallback_error','request_meta_first','fallback_meta','verify_trace','sat_request_id','auth_ms','request_ms',
+    'verify_ms','download_ms','total_found','total_downloaded','created_at','updated_at',
+])
+
+
 @router.get('/debug/job-trace/{job_id}')
 def debug_job_trace(job_id: str):
     """Devuelve campos clave de un sat_job para diagnóstico rápido (no requiere passphrase)."""
     try:
-        from ..supabase_client import get_supabase
         sb = get_supabase()
-        resp = sb.table('sat_jobs').select('*').eq('id', job_id).maybe_single().execute()
+        resp = sb.table('sat_jobs').select(_JOB_TRACE_KEEP).eq('id', job_id).maybe_single().execute()
         data = getattr(resp, 'data', None)
         if not data:
             raise HTTPException(status_code=404, detail='job no encontrado')
-        keep = ['id','status','error','note','tipo_solicitud_final','fallback_from_cfdi','request_meta','request_error','fallback_error','request_meta_first','fallback_meta','verify_trace','sat_request_id','auth_ms','request_ms','verify_ms','download_ms','total_found','total_downloaded','created_at','updated_at']
-        slim = {k: data.get(k) for k in keep}
-        return {'job': slim}
+        return {'job': data}
     except HTTPException:
         raise
     except Exception as e:
@@ -147,9 +307,15 @@ class VerifyRequest(BaseModel):
 
 @router.post('/verify')
 def verify_firma(req: VerifyRequest):
+    return _verify_firma_impl(req.user_id, req.passphrase)
+
+
+# Las variantes GET comparten la implementación plana en lugar de reconstruir el
+# modelo Pydantic del POST sólo para re-despachar (validadores incluidos).
+def _verify_firma_impl(user_id: str, passphrase: Optional[str]):
     try:
-        provider = SatProvider()
-        info = provider.verify_firma(req.user_id, req.passphrase)
+        provider = _get_provider()
+        info = provider.verify_firma(user_id, passphrase)
         return info
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -158,41 +324,46 @@ def verify_firma(req: VerifyRequest):
 @router.get('/verify/{user_id}')
 def verify_firma_get(user_id: str, passphrase: Optional[str] = Query(default=None)):
     """Conveniencia GET sólo para desarrollo (la passphrase iría en la URL)."""
-    return verify_firma(VerifyRequest(user_id=user_id, passphrase=passphrase))
+    return _verify_firma_impl(user_id, passphrase)
 
 
 class InspectRequest(BaseModel):
     user_id: str
 
 
+# Clasificación de errores de inspect: una sola pasada de regex (grupos nombrados)
+# en lugar de encadenar substring-checks sobre el mensaje en cada fallo.
+_INSPECT_ERR_RE = re.compile(
+    r'(?P<profile_not_found>perfil no encontrado)'
+    r'|(?P<missing_firma_ref>perfil sin referencia|firma_ref)'
+    r'|(?P<cer_not_found>no se encontró archivo \.cer)'
+    r'|(?P<cer_key_missing>no se encontraron archivos \.cer y \.key)'
+    r'|(?P<cer_parse_error>no se pudo leer el certificado|certificado \.cer inválido)'
+)
+
+
 @router.post('/inspect')
 def inspect_firma(req: InspectRequest):
     """Analiza el .cer y devuelve sugerencias para autocompletar el perfil (RFC, nombre, vigencia)."""
+    return _inspect_firma_impl(req.user_id)
+
+
+def _inspect_firma_impl(user_id: str):
     try:
-        provider = SatProvider()
-        return provider.inspect_firma(req.user_id)
+        provider = _get_provider()
+        return provider.inspect_firma(user_id)
     except Exception as e:
         # Clasificar error para que el frontend pueda dar feedback claro
         msg = str(e)
-        code = 'unknown'
-        lowered = msg.lower()
-        if 'perfil no encontrado' in lowered:
-            code = 'profile_not_found'
-        elif 'perfil sin referencia' in lowered or 'firma_ref' in lowered:
-            code = 'missing_firma_ref'
-        elif 'no se encontró archivo .cer' in lowered:
-            code = 'cer_not_found'
-        elif 'no se encontraron archivos .cer y .key' in lowered:
-            code = 'cer_key_missing'
-        elif 'no se pudo leer el certificado' in lowered or 'certificado .cer inválido' in lowered:
-            code = 'cer_parse_error'
+        m = _INSPECT_ERR_RE.search(msg.lower())
+        code = m.lastgroup if m else 'unknown'
         raise HTTPException(status_code=400, detail={'message': msg, 'code': code})
 
 
 @router.get('/inspect/{user_id}')
 def inspect_firma_get(user_id: str):
     """Versión GET para pruebas rápidas en navegador."""
-    return inspect_firma(InspectRequest(user_id=user_id))
+    return _inspect_firma_impl(user_id)
 
 
 class AuthRequest(BaseModel):
@@ -200,41 +371,73 @@ class AuthRequest(BaseModel):
     passphrase: str
 
 
+# Single-flight: llamadas concurrentes idénticas a /auth o /test-flow comparten
+# el trabajo SOAP+firma RSA del primero; los duplicados esperan su misma tarea.
+_INFLIGHT: dict = {}
+
+
+async def _single_flight(key: str, factory):
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _t: _INFLIGHT.pop(key, None))
+    # shield: que un cliente desconectado no cancele el trabajo compartido
+    return await asyncio.shield(task)
+
+
+async def _auth_sat_async(user_id: str, passphrase: str):
+    # La passphrase entra hasheada a la llave: no se retiene en claro en el dict
+    key = f"auth:{user_id}:{hashlib.blake2s(passphrase.encode('utf-8')).hexdigest()}"
+    return await _single_flight(key, lambda: asyncio.to_thread(_auth_sat_impl, user_id, passphrase))
+
+
 @router.post('/auth')
-def auth_sat(req: AuthRequest):
+async def auth_sat(req: AuthRequest):
     """Prueba directa de autenticación SAT 2.0. Devuelve tamaño del token (no el token)."""
+    return await _auth_sat_async(req.user_id, req.passphrase)
+
+
+def _auth_sat_impl(user_id: str, passphrase: str):
     try:
-        provider = SatProvider()
+        provider = _get_provider()
         # Validaciones previas: tipo de certificado y vigencia
         try:
-            info = provider.inspect_firma(req.user_id)
+            info = provider.inspect_firma(user_id)
             if info.get('is_probably_csd'):
                 raise HTTPException(status_code=400, detail='El certificado parece ser CSD. La autenticación del SAT requiere e.firma (FIEL). Sube tu FIEL (.cer/.key) con su contraseña.')
-            # Validar vigencia
-            from datetime import datetime as _dt
-            vf, vt = info.get('valid_from'), info.get('valid_to')
-            if isinstance(vf, str) and isinstance(vt, str):
-                now = _dt.utcnow().isoformat()
-                if now < vf or now > vt:
-                    raise HTTPException(status_code=400, detail=f'Certificado fuera de vigencia (valid_from={vf}, valid_to={vt}).')
+            # Validar vigencia con epoch ints (inspect_firma los precalcula);
+            # comparación entera en vez de strings ISO lexicográficos.
+            vf_ts, vt_ts = info.get('valid_from_ts'), info.get('valid_to_ts')
+            if isinstance(vf_ts, int) and isinstance(vt_ts, int):
+                if not (vf_ts <= int(time.time()) <= vt_ts):
+                    raise HTTPException(status_code=400, detail=f"Certificado fuera de vigencia (valid_from={info.get('valid_from')}, valid_to={info.get('valid_to')}).")
+            else:
+                # Respuesta sin timestamps (versión previa de inspect): comparar ISO
+                from datetime import datetime as _dt
+                vf, vt = info.get('valid_from'), info.get('valid_to')
+                if isinstance(vf, str) and isinstance(vt, str):
+                    now = _dt.utcnow().isoformat()
+                    if now < vf or now > vt:
+                        raise HTTPException(status_code=400, detail=f'Certificado fuera de vigencia (valid_from={vf}, valid_to={vt}).')
         except HTTPException:
             raise
         except Exception:
             # Si falla la inspección, continuamos, la autenticación reportará el problema
             pass
 
-        cer, key = provider.load_firma(req.user_id)  # type: ignore[attr-defined]
-        client = Sat20Client()
-        token = client.authenticate(cer, key, req.passphrase)
+        cer, key = provider.load_firma(user_id)  # type: ignore[attr-defined]
+        client = _get_sat20()
+        token = client.authenticate(cer, key, passphrase)
         return { 'ok': True, 'token_len': len(token) }
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
 
 @router.get('/auth/{user_id}')
-def auth_sat_get(user_id: str, passphrase: str = Query(...)):
+async def auth_sat_get(user_id: str, passphrase: str = Query(...)):
     """Versión GET para pruebas locales (NO producción)."""
-    return auth_sat(AuthRequest(user_id=user_id, passphrase=passphrase))
+    return await _auth_sat_async(user_id, passphrase)
 
 
 class ProfileUpsertRequest(BaseModel):
@@ -242,6 +445,18 @@ class ProfileUpsertRequest(BaseModel):
     rfc: str
     firma_ref: str
 
+    # Normalización en la validación del modelo: el handler recibe los valores
+    # ya limpios y no repite upper/strip por request.
+    @field_validator('rfc')
+    @classmethod
+    def _norm_rfc(cls, v: str) -> str:
+        return v.strip().upper()
+
+    @field_validator('firma_ref')
+    @classmethod
+    def _norm_firma_ref(cls, v: str) -> str:
+        return v.strip().rstrip('/')
+
 
 @router.post('/profile/upsert')
 def profile_upsert(req: ProfileUpsertRequest):
@@ -249,21 +464,25 @@ def profile_upsert(req: ProfileUpsertRequest):
 
     NOTA: En producción proteger con auth/RLS adecuada."""
     try:
-        from ..supabase_client import get_supabase
         sb = get_supabase()
-        payload = {
-            'user_id': req.user_id,
-            'rfc': req.rfc.upper().strip(),
-            'firma_ref': req.firma_ref.strip().rstrip('/'),
-        }
+        payload = req.model_dump(include={'user_id', 'rfc', 'firma_ref'})
         # upsert: si existe user_id lo actualiza
         resp = sb.table('profiles').upsert(payload, on_conflict='user_id').execute()
         data = getattr(resp, 'data', None)
+        # El perfil (y posiblemente su firma_ref) cambió: tirar los memos
+        provider = _get_provider()
+        provider.invalidate_profile(req.user_id)
+        provider.invalidate_firma(req.firma_ref)
         return { 'ok': True, 'profile': data }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Respuestas de listado cacheadas unos segundos: los dashboards refrescan en ráfagas
+# con los mismos parámetros y la tabla cfdi sólo cambia cuando corre un job.
+_CFDI_LIST_CACHE: TTLCache = TTLCache(maxsize=256, ttl=15)
+
+
 @router.get('/cfdi/list')
 def list_cfdi(
     company_id: str = Query(..., description="UUID de la compañía"),
@@ -279,43 +498,137 @@ def list_cfdi(
     NOTA: Este endpoint asume que la política RLS limita el acceso por company_id al propietario.
     En producción añadir autenticación/JWT y asociación user_id->company.
     """
+    cache_key = (company_id, limit, offset, uuid, kind, date_from, date_to)
+    cached = _CFDI_LIST_CACHE.get(cache_key)
+    if cached is not None:
+        return cached
     try:
-        from ..supabase_client import get_supabase
         sb = get_supabase()
-        query = sb.table('cfdi').select('uuid,fecha,emisor_rfc,receptor_rfc,total,tipo').eq('company_id', company_id)
-        if uuid:
-            query = query.eq('uuid', uuid)
-        if kind:
-            query = query.eq('tipo', kind)
-        if date_from:
-            query = query.gte('fecha', date_from)
-        if date_to:
-            query = query.lte('fecha', date_to)
-        resp = query.range(offset, offset + limit - 1).execute()
-        data = getattr(resp, 'data', None)
+        data = None
+        # Camino rápido: RPC sp_cfdi_list (ver docs/migrations/2026-09-01_sp_cfdi_list_rpc.sql):
+        # una sola consulta preparada con plan cacheado e índice (company_id, fecha desc),
+        # en lugar de la cadena de filtros que PostgREST re-genera por combinación.
+        try:
+            resp = sb.rpc('sp_cfdi_list', {
+                'p_company': company_id,
+                'p_uuid': uuid,
+                'p_tipo': kind,
+                'p_from': date_from,
+                'p_to': date_to,
+                'p_limit': limit,
+                'p_offset': offset,
+            }).execute()
+            data = getattr(resp, 'data', None)
+        except Exception:
+            data = None  # función aún no desplegada: usar filtros PostgREST
+        if data is None:
+            query = sb.table('cfdi').select('uuid,fecha,emisor_rfc,receptor_rfc,total,tipo').eq('company_id', company_id)
+            if uuid:
+                query = query.eq('uuid', uuid)
+            if kind:
+                query = query.eq('tipo', kind)
+            if date_from:
+                query = query.gte('fecha', date_from)
+            if date_to:
+                query = query.lte('fecha', date_to)
+            resp = query.range(offset, offset + limit - 1).execute()
+            data = getattr(resp, 'data', None)
         if not isinstance(data, list):
             data = []
-        return { 'items': data, 'count': len(data), 'limit': limit, 'offset': offset }
+        result = { 'items': data, 'count': len(data), 'limit': limit, 'offset': offset }
+        _CFDI_LIST_CACHE[cache_key] = result
+        return result
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get('/cfdi/batch')
+async def batch_cfdi(uuids: str = Query(..., description="UUIDs separados por coma (máx 100)")):
+    """Devuelve varios XML en una sola llamada para evitar el patrón N+1 de
+    "listar UUIDs y pedir /cfdi/{uuid}/raw uno por uno".
+
+    Un único SELECT con IN-list resuelve los xml_ref y las descargas de Storage
+    corren en paralelo; la respuesta es {uuid: xml_base64} (null si no existe).
+    """
+    import base64
+    wanted = [u.strip() for u in uuids.split(',') if u.strip()]
+    if not wanted:
+        raise HTTPException(status_code=400, detail='Se requiere al menos un UUID')
+    if len(wanted) > 100:
+        raise HTTPException(status_code=400, detail='Máximo 100 UUIDs por llamada')
+    try:
+        sb = get_supabase()
+        resp = await asyncio.to_thread(
+            lambda: sb.table('cfdi').select('uuid,xml_ref').in_('uuid', wanted).execute()
+        )
+        rows = getattr(resp, 'data', None) or []
+        refs = {r['uuid']: r.get('xml_ref') for r in rows if r.get('uuid')}
+        bucket = os.environ.get('CFDI_BUCKET', 'cfdi-xml')
+        storage = sb.storage.from_(bucket)
+
+        def _download(ref):
+            try:
+                return storage.download(ref)
+            except Exception:
+                return None
+
+        pairs = [(u, ref) for u, ref in refs.items() if ref]
+        blobs = await asyncio.gather(*[asyncio.to_thread(_download, ref) for _, ref in pairs])
+        out = {u: None for u in wanted}
+        for (u, _ref), blob in zip(pairs, blobs):
+            if blob:
+                out[u] = base64.b64encode(blob).decode('ascii')
+        return {'items': out, 'found': sum(1 for v in out.values() if v), 'requested': len(wanted)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def _raw_cfdi_locate(uuid: str):
+    """Resuelve (xml_ref, bucket, signed_url) para un CFDI; corre en threadpool."""
+    sb = get_supabase()
+    resp = sb.table('cfdi').select('xml_ref').eq('uuid', uuid).maybe_single().execute()
+    data = getattr(resp, 'data', None)
+    if not data or not data.get('xml_ref'):
+        return None
+    xml_ref = data['xml_ref']
+    bucket = os.environ.get('CFDI_BUCKET', 'cfdi-xml')
+    signed_url = None
+    try:
+        signed = sb.storage.from_(bucket).create_signed_url(xml_ref, 60)
+        if isinstance(signed, dict):
+            signed_url = signed.get('signedURL') or signed.get('signedUrl')
+    except Exception:
+        signed_url = None
+    return xml_ref, bucket, signed_url
+
+
 @router.get('/cfdi/{uuid}/raw')
-def raw_cfdi(uuid: str):
+async def raw_cfdi(uuid: str):
     """Devuelve el XML original del CFDI desde Storage.
 
     Usa la columna 'xml_ref' en la tabla 'cfdi' que apunta al path en el bucket (CFDI_BUCKET o 'cfdi-xml').
+    El XML se transmite en streaming (chunks de 64 KiB) desde una URL firmada sin
+    materializarlo completo en memoria; si no hay URL firmada se descarga en threadpool.
     """
     try:
-        from ..supabase_client import get_supabase
-        sb = get_supabase()
-        resp = sb.table('cfdi').select('xml_ref').eq('uuid', uuid).maybe_single().execute()
-        data = getattr(resp, 'data', None)
-        if not data or not data.get('xml_ref'):
+        located = await run_in_threadpool(_raw_cfdi_locate, uuid)
+        if located is None:
             raise HTTPException(status_code=404, detail='CFDI no encontrado')
-        xml_ref = data['xml_ref']
-        bucket = os.environ.get('CFDI_BUCKET', 'cfdi-xml')
-        xml_bytes = sb.storage.from_(bucket).download(xml_ref)
+        xml_ref, bucket, signed_url = located
+        if signed_url:
+            async def _stream():
+                async with httpx.AsyncClient() as client:
+                    async with client.stream('GET', signed_url) as r:
+                        r.raise_for_status()
+                        async for chunk in r.aiter_bytes(65536):
+                            yield chunk
+            return StreamingResponse(_stream(), media_type='application/xml')
+        # Fallback (bucket sin URLs firmadas): descarga bloqueante fuera del event loop
+        xml_bytes = await run_in_threadpool(
+            lambda: get_supabase().storage.from_(bucket).download(xml_ref)
+        )
         if not xml_bytes:
             raise HTTPException(status_code=404, detail='XML no encontrado en storage')
         # Aseguramos media_type correcto
@@ -329,7 +642,7 @@ def raw_cfdi(uuid: str):
 @router.get('/self-check')
 def self_check():
     try:
-        provider = SatProvider()
+        provider = _get_provider()
         return provider.self_check()  # type: ignore[attr-defined]
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -389,69 +702,60 @@ class TestFlowRequest(BaseModel):
 
 
 @router.post('/test-flow')
-def test_flow(req: TestFlowRequest):
+async def test_flow(req: TestFlowRequest):
     """Prueba controlada: autentica, solicita, verifica y lista paquetes.
 
     - No expone el token; sólo longitud.
     - Si encuentra paquetes, no descarga todos los XML; devuelve conteo.
     """
-    try:
-        provider = SatProvider()
-        cer, key = provider.load_firma(req.user_id)  # type: ignore[attr-defined]
-        client = Sat20Client()
-
-        # Permitir overrides de entorno para autenticación en esta llamada
-        import os as _os
-        from typing import Dict, Optional as _Optional
-        _restore: Dict[str, _Optional[str]] = {}
-        def _setenv(k: str, v: Optional[str]):
-            _restore[k] = _os.environ.get(k)
-            if v is None:
-                if k in _os.environ:
-                    del _os.environ[k]
-            else:
-                _os.environ[k] = v
+    # Dos test-flows idénticos en vuelo comparten una sola pasada contra el SAT
+    key = 'test-flow:' + hashlib.blake2s(
+        repr(sorted(req.model_dump().items())).encode('utf-8')
+    ).hexdigest()
+    return await _single_flight(key, lambda: _test_flow_run(req))
 
-        try:
-            if req.manual_auth is not None:
-                _setenv('SAT_MANUAL_AUTH', '1' if req.manual_auth else '0')
-            if req.force_alg is not None:
-                if req.force_alg.lower() == 'auto':
-                    _setenv('SAT_FORCE_ALG', None)
-                else:
-                    _setenv('SAT_FORCE_ALG', req.force_alg)
-            if req.force_digest is not None:
-                _setenv('SAT_FORCE_DIGEST', req.force_digest)
-            if req.wsse_bst is not None:
-                _setenv('SAT_WSSE_BST', '1' if req.wsse_bst else '0')
-            if req.solicitud_manual is not None:
-                _setenv('SAT_SOLICITUD_MANUAL', '1' if req.solicitud_manual else '0')
-            if req.full_lib is not None:
-                _setenv('SAT_USE_SATCFDI_FULL', '1' if req.full_lib else '0')
-
-            token = client.authenticate(cer, key, req.passphrase)
-        finally:
-            for k, v in _restore.items():
-                if v is None:
-                    if k in _os.environ:
-                        del _os.environ[k]
-                else:
-                    _os.environ[k] = v
+
+async def _test_flow_run(req: TestFlowRequest):
+    try:
+        provider = _get_provider()
+        cer, key = await asyncio.to_thread(provider.load_firma, req.user_id)  # type: ignore[attr-defined]
+        client = _get_sat20()
+
+        # Overrides SAT_* sólo para esta llamada: se pasan explícitos al cliente en
+        # lugar de mutar os.environ, así dos /test-flow concurrentes no se pisan.
+        overrides: dict = {}
+        if req.manual_auth is not None:
+            overrides['SAT_MANUAL_AUTH'] = '1' if req.manual_auth else '0'
+        if req.force_alg is not None:
+            overrides['SAT_FORCE_ALG'] = None if req.force_alg.lower() == 'auto' else req.force_alg
+        if req.force_digest is not None:
+            overrides['SAT_FORCE_DIGEST'] = req.force_digest
+        if req.wsse_bst is not None:
+            overrides['SAT_WSSE_BST'] = '1' if req.wsse_bst else '0'
+        if req.solicitud_manual is not None:
+            overrides['SAT_SOLICITUD_MANUAL'] = '1' if req.solicitud_manual else '0'
+        if req.full_lib is not None:
+            overrides['SAT_USE_SATCFDI_FULL'] = '1' if req.full_lib else '0'
+
+        # Autenticación SOAP y resolución de RFC (inspect + perfil) son independientes:
+        # se lanzan en paralelo sobre hilos y se espera el conjunto.
+        token, info, prof = await asyncio.gather(
+            asyncio.to_thread(client.authenticate, cer, key, req.passphrase, overrides=overrides or None),
+            asyncio.to_thread(provider.inspect_firma, req.user_id),
+            asyncio.to_thread(provider._get_profile, req.user_id, require_rfc=False),  # type: ignore[attr-defined]
+            return_exceptions=True,
+        )
+        if isinstance(token, BaseException):
+            raise token
         out = { 'ok': True, 'token_len': len(token) }
 
         # Determinar RFC a usar: preferimos el del certificado para evitar 'Sello No Corresponde al RFC'
         cert_rfc: Optional[str] = None
         profile_rfc: Optional[str] = None
-        try:
-            info = provider.inspect_firma(req.user_id)
+        if not isinstance(info, BaseException):
             cert_rfc = (info.get('rfc') or info.get('rfc_profile') or '').upper() or None
-        except Exception:
-            cert_rfc = None
-        try:
-            prof = provider._get_profile(req.user_id, require_rfc=False)  # type: ignore[attr-defined]
+        if not isinstance(prof, BaseException):
             profile_rfc = (prof.get('rfc') or '').upper() or None
-        except Exception:
-            profile_rfc = None
         # Elegir RFC final
         rfc = (req.rfc or cert_rfc or profile_rfc)
         if not rfc:
@@ -470,7 +774,8 @@ def test_flow(req: TestFlowRequest):
 
         # 1) Solicitar descarga (capturando metadatos de rechazo para diagnóstico)
         try:
-            req_id = client.request_download(
+            req_id = await asyncio.to_thread(
+                client.request_download,
                 token,
                 rfc,
                 df,
@@ -483,6 +788,7 @@ def test_flow(req: TestFlowRequest):
                 cer_bytes=cer,
                 key_bytes=key,
                 key_passphrase=req.passphrase,
+                overrides=overrides or None,
             )
             out['rfc_used'] = rfc  # type: ignore[index]
             out['request_id'] = req_id  # type: ignore[index]
@@ -495,7 +801,8 @@ def test_flow(req: TestFlowRequest):
             if 'CodEstatus=301' in err_txt and 'cancelad' in err_txt.lower() and (req.tipo_solicitud or 'CFDI').upper() == 'CFDI':
                 try:
                     fallback_attempted = True
-                    req_id = client.request_download(
+                    req_id = await asyncio.to_thread(
+                        client.request_download,
                         token,
                         rfc,
                         df,
@@ -508,6 +815,7 @@ def test_flow(req: TestFlowRequest):
                         cer_bytes=cer,
                         key_bytes=key,
                         key_passphrase=req.passphrase,
+                        overrides=overrides or None,
                     )
                     out['rfc_used'] = rfc  # type: ignore[index]
                     out['request_id'] = req_id  # type: ignore[index]
@@ -526,11 +834,11 @@ def test_flow(req: TestFlowRequest):
                 # No se logró solicitud (sin fallback exitoso)
                 # Adjuntar envelope snippet si existe
                 try:
-                    if os.path.exists('sat_request_envelope.xml'):
-                        with open('sat_request_envelope.xml','rb') as fh:
-                            env_bytes = fh.read(1500)
-                        import base64 as _b64
-                        out['request_envelope_b64'] = _b64.b64encode(env_bytes).decode('ascii')  # type: ignore[index]
+                    import binascii as _binascii
+                    buf = bytearray(1500)
+                    with open('sat_request_envelope.xml','rb') as fh:
+                        n = fh.readinto(buf) or 0
+                    out['request_envelope_b64'] = _binascii.b2a_base64(memoryview(buf)[:n], newline=False).decode('ascii')  # type: ignore[index]
                 except Exception:
                     pass
                 if not fallback_attempted:
@@ -544,7 +852,7 @@ def test_flow(req: TestFlowRequest):
         if 'request_id' not in out:
             return out
         try:
-            pkgs = client.wait_and_list_packages(token, out['request_id'])
+            pkgs = await asyncio.to_thread(client.wait_and_list_packages, token, out['request_id'])
             out['packages_count'] = len(pkgs)  # type: ignore[index]
             out['packages'] = pkgs[:5]  # muestra primeros
             # Extraer traza si se activó SAT_TRACE_VERIFY=1
@@ -565,7 +873,7 @@ def test_flow(req: TestFlowRequest):
 
 
 @router.get('/test')
-def test_flow_get(
+async def test_flow_get(
     user_id: str,
     passphrase: str,
     kind: SatKind = SatKind.recibidos,
@@ -577,7 +885,8 @@ def test_flow_get(
     tipo_comprobante: Optional[str] = None,
 ):
     """Versión GET del flujo de prueba (para rapidez en dev)."""
-    return test_flow(TestFlowRequest(
+    # model_construct evita re-correr validadores sobre valores que FastAPI ya parseó
+    return await test_flow(TestFlowRequest.model_construct(
         user_id=user_id,
         passphrase=passphrase,
         kind=kind,
@@ -598,7 +907,7 @@ def debug_profile(user_id: str):
     No expone contenido de archivos, sólo nombres; no requiere passphrase.
     """
     try:
-        provider = SatProvider()
+        provider = _get_provider()
         return provider.debug_profile(user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -612,66 +921,145 @@ def debug_firma(user_id: str):
     Devuelve tamaños, hash SHA256 del .cer y fechas de vigencia.
     """
     try:
-        provider = SatProvider()
+        provider = _get_provider()
         return provider.debug_firma(user_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Snippets de artefactos SOAP ya leídos, keyed por filename -> (huella stat, (bytes, size)).
+# Los archivos sólo cambian cuando corre una nueva petición con SAT_SAVE_SOAP=1.
+_SNIPPET_CACHE: dict = {}
+
+
+def _read_snippet(fname: str, nbytes: int):
+    """Lee los primeros nbytes de un artefacto SOAP, con cache invalidada por stat.
+
+    Un solo os.stat (EAFP) reemplaza el par exists()+open(); devuelve None si el
+    archivo no existe y (bytes, tamaño_total) si existe.
+    """
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return None
+    key = (st.st_mtime_ns, st.st_size, nbytes)
+    cached = _SNIPPET_CACHE.get(fname)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    # readinto sobre un buffer preasignado: una sola asignación por miss en vez
+    # del bytes intermedio de read(nbytes) + slice.
+    buf = bytearray(nbytes)
+    with open(fname, 'rb') as fh:
+        n = fh.readinto(buf) or 0
+    entry = (bytes(memoryview(buf)[:n]), st.st_size)
+    _SNIPPET_CACHE[fname] = (key, entry)
+    return entry
+
+
 @router.get('/debug/last-request')
-def debug_last_request():  # pragma: no cover - diagnóstico
+async def debug_last_request():  # pragma: no cover - diagnóstico
     """Devuelve snippets base64 de los últimos envelopes/request/response guardados si SAT_SAVE_SOAP=1.
 
     Archivos considerados: sat_auth_envelope.xml, sat_request_envelope.xml, sat_request_response.xml.
     Solo devuelve primeros ~4000 bytes de cada uno codificados en base64 para no saturar la respuesta.
     """
-    import base64, os
+    import binascii
     files = ['sat_auth_envelope.xml','sat_request_envelope.xml','sat_request_response.xml','sat_auth_fault_response.xml']
-    out = {}
-    for fname in files:
-        if os.path.exists(fname):
+
+    def _collect():
+        out = {}
+        for fname in files:
             try:
-                with open(fname,'rb') as fh:
-                    data = fh.read(4000)
-                out[fname] = base64.b64encode(data).decode('ascii')
+                snap = _read_snippet(fname, 4000)
             except Exception as e:
                 out[fname] = f'error:{e}'
-    return out
+                continue
+            if snap is not None:
+                # b2a_base64 sin newline evita el wrapping y un strip posterior
+                out[fname] = binascii.b2a_base64(snap[0], newline=False).decode('ascii')
+        return out
+
+    return await run_in_threadpool(_collect)
+
+
+# [mtime, sha1_12] del archivo ya hasheado; se invalida solo cuando cambia el mtime.
+_BUILD_INFO_SHA: list = []
 
 
 @router.get('/debug/build-info')
-def debug_build_info():  # pragma: no cover
+def debug_build_info(request: Request):  # pragma: no cover
     """Devuelve información de versión del código cargado para diagnosticar si el servidor corriendo
     corresponde a la versión más reciente del archivo sat.py.
 
     Incluye:
       - mtime (fecha de modificación) del archivo sat.py en disco según el proceso actual
-      - un hash sha1 corto de su contenido
+      - un hash corto (BLAKE2b) de su contenido
       - process_id para confirmar qué proceso atiende
     """
     import os, hashlib
     path = __file__
-    try:
-        with open(path,'rb') as fh:
-            data = fh.read()
-        sha = hashlib.sha1(data).hexdigest()[:12]
-    except Exception as e:
-        sha = f'error:{e}'
     try:
         mtime = os.path.getmtime(path)
     except Exception:
         mtime = None
-    return {
-        'file': path,
-        'mtime': mtime,
-        'sha1_12': sha,
-        'pid': os.getpid(),
-        'has_fallback_logic': True,  # bandera manual para confirmar que es la versión parcheada
-    }
+    # El hash sólo cambia si cambió el archivo: lo memorizamos por mtime para no
+    # releer y re-hashear el módulo completo en cada consulta de diagnóstico.
+    # BLAKE2b con digest de 6 bytes: es un identificador, no criptografía, y es
+    # bastante más barato que SHA1 sobre el archivo completo.
+    if mtime is not None and _BUILD_INFO_SHA and _BUILD_INFO_SHA[0] == mtime:
+        sha = _BUILD_INFO_SHA[1]
+    else:
+        try:
+            with open(path,'rb') as fh:
+                data = fh.read()
+            sha = hashlib.blake2b(data, digest_size=6).hexdigest()
+            if mtime is not None:
+                _BUILD_INFO_SHA[:] = [mtime, sha]
+        except Exception as e:
+            sha = f'error:{e}'
+    # ETag condicional: los polls de diagnóstico con el código sin cambios
+    # responden 304 sin cuerpo en lugar de re-serializar el JSON.
+    etag = f'"{sha}:{os.getpid()}"'
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers={'ETag': etag})
+    return JSONResponse(
+        {
+            'file': path,
+            'mtime': mtime,
+            'hash_12': sha,
+            'sha1_12': sha,  # alias legado; clientes viejos comparan este campo
+            'pid': os.getpid(),
+            'has_fallback_logic': True,  # bandera manual para confirmar que es la versión parcheada
+        },
+        headers={'ETag': etag, 'Cache-Control': 'max-age=30'},
+    )
+
+
+# [n_rutas, etag, body_bytes] ya serializados: la tabla de rutas sólo cambia al
+# (re)arrancar el proceso, así que se invalida con un simple compare de longitud.
+_ROUTES_CACHE: list = []
+
+
+def _build_routes_cache() -> tuple:
+    import hashlib
+    out = []
+    for r in router.routes:  # type: ignore[attr-defined]
+        methods = list(getattr(r, 'methods', []) or [])
+        path = getattr(r, 'path', None)
+        name = getattr(r, 'name', None)
+        out.append({'path': path, 'methods': methods, 'name': name})
+    # Ordenar para consistencia
+    out.sort(key=lambda x: (x['path'] or '', ','.join(x['methods'])))
+    etag = '"' + hashlib.sha1(
+        '|'.join(f"{r['path']}:{','.join(r['methods'])}" for r in out).encode()
+    ).hexdigest()[:12] + '"'
+    body = orjson.dumps({'count': len(out), 'routes': out})
+    _ROUTES_CACHE[:] = [len(router.routes), etag, body]
+    return etag, body
 
 
 @router.get('/debug/routes')
-def debug_routes():  # pragma: no cover - endpoint de diagnóstico
+def debug_routes(request: Request):  # pragma: no cover - endpoint de diagnóstico
     """Lista todas las rutas registradas actualmente en la app.
 
     Útil cuando parece que cambios al archivo no se reflejan (hot-reload).
@@ -679,16 +1067,17 @@ def debug_routes():  # pragma: no cover - endpoint de diagnóstico
     entonces estás ejecutando un proceso que no cargó esta versión de sat.py.
     """
     try:
-        # La app quedará disponible cuando el router se monte; introspeccionamos via router.routes
-        out = []
-        for r in router.routes:  # type: ignore[attr-defined]
-            methods = list(getattr(r, 'methods', []) or [])
-            path = getattr(r, 'path', None)
-            name = getattr(r, 'name', None)
-            out.append({'path': path, 'methods': methods, 'name': name})
-        # Ordenar para consistencia
-        out.sort(key=lambda x: (x['path'] or '', ','.join(x['methods'])))
-        return {'count': len(out), 'routes': out}
+        if _ROUTES_CACHE and _ROUTES_CACHE[0] == len(router.routes):
+            etag, body = _ROUTES_CACHE[1], _ROUTES_CACHE[2]
+        else:
+            etag, body = _build_routes_cache()
+        if request.headers.get('if-none-match') == etag:
+            return Response(status_code=304, headers={'ETag': etag})
+        return Response(
+            content=body,
+            media_type='application/json',
+            headers={'ETag': etag, 'Cache-Control': 'max-age=30'},
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -697,7 +1086,7 @@ def debug_routes():  # pragma: no cover - endpoint de diagnóstico
 def debug_firma_files(user_id: str):
     """Lista sólo los nombres de archivos bajo la firma_ref del perfil."""
     try:
-        provider = SatProvider()
+        provider = _get_provider()
         raw = provider.debug_profile(user_id)
         return {
             'exists': raw.get('exists'),
@@ -712,34 +1101,137 @@ def debug_firma_files(user_id: str):
 
 
 @router.get('/debug/auth-artifacts')
-def debug_auth_artifacts():
+async def debug_auth_artifacts():
     """Devuelve si  existen los archivos sat_auth_envelope.xml y sat_auth_fault_response.xml.
 
     Útil cuando SAT_SAVE_SOAP=1 y SAT_DEBUG=1 para inspeccionar la última petición/respuesta.
     Incluye un snippet (primeros 400 caracteres) para revisión rápida.
     """
     files = ['sat_auth_envelope.xml', 'sat_auth_fault_response.xml']
-    out = {}
-    import os
-    for fname in files:
-        if os.path.exists(fname):
+
+    def _collect():
+        out = {}
+        for fname in files:
             try:
-                with open(fname, 'r', encoding='utf-8', errors='ignore') as fh:
-                    txt = fh.read()
+                snap = _read_snippet(fname, 2048)
+            except Exception as e:
+                out[fname] = {'exists': True, 'error': str(e)}
+                continue
+            if snap is None:
+                out[fname] = {'exists': False}
+            else:
+                txt = snap[0].decode('utf-8', errors='ignore')
                 out[fname] = {
                     'exists': True,
-                    'size': len(txt),
+                    'size': snap[1],
                     'snippet': txt[:400]
                 }
-            except Exception as e:
-                out[fname] = {'exists': True, 'error': str(e)}
-        else:
-            out[fname] = {'exists': False}
+        return out
+
+    return await run_in_threadpool(_collect)
+
+
+@lru_cache(maxsize=4)
+def _get_wsdl_client(wsdl_url: str):
+    """Cliente zeep por WSDL, construido una sola vez por proceso.
+
+    Parsear un WSDL del SAT descarga y compila esquemas XSD grandes; con el
+    cache Sqlite de zeep los documentos además sobreviven reinicios.
+    """
+    import tempfile
+    import zeep  # type: ignore
+    try:
+        from zeep.cache import SqliteCache  # type: ignore
+        from zeep.transports import Transport  # type: ignore
+        cache = SqliteCache(path=os.path.join(tempfile.gettempdir(), 'zeep_wsdl_cache.db'), timeout=86400)
+        return zeep.Client(wsdl_url, transport=Transport(cache=cache))
+    except Exception:
+        return zeep.Client(wsdl_url)
+
+
+@lru_cache(maxsize=4)
+def _get_async_wsdl_client(wsdl_url: str):
+    """Cliente zeep asíncrono por WSDL (AsyncTransport sobre httpx).
+
+    A diferencia del cliente sync (un hilo pineado por llamada SOAP en
+    vuelo), aquí las llamadas comparten el event loop y, con HTTP/2, una
+    sola conexión TLS multiplexada: un handshake amortizado entre muchas
+    operaciones. El parseo del WSDL sigue siendo síncrono, por eso la
+    construcción se hace una vez por URL y fuera del loop.
+    """
+    import zeep  # type: ignore
+    from zeep.transports import AsyncTransport  # type: ignore
+    limits = httpx.Limits(max_connections=200, max_keepalive_connections=100)
+    try:
+        client = httpx.AsyncClient(http2=True, limits=limits, timeout=30)
+    except ImportError:
+        # Sin el paquete h2: HTTP/1.1 con keep-alive sigue evitando handshakes
+        client = httpx.AsyncClient(limits=limits, timeout=30)
+    return zeep.AsyncClient(wsdl_url, transport=AsyncTransport(client=client))
+
+
+# Introspección de WSDL precalculada: listas de operaciones por cliente y
+# firmas de solicitud. Los WSDL del SAT son fijos, así que el resultado no
+# cambia durante la vida del proceso.
+_WSDL_OPS_CACHE: dict = {}
+_REQUEST_SIGNATURES: Optional[dict] = None
+
+
+def _wsdl_ops(client) -> list:
+    """Nombres de operaciones del primer puerto del cliente (memoizado)."""
+    cached = _WSDL_OPS_CACHE.get(id(client))
+    if cached is not None:
+        return cached
+    names: list = []
+    try:
+        for svc in client.wsdl.services.values():  # type: ignore[attr-defined]
+            for port in svc.ports.values():  # type: ignore[attr-defined]
+                names = sorted(list(port.binding._operations.keys()))  # type: ignore[attr-defined]
+                break
+            break
+    except Exception:
+        names = []
+    # id() es estable aquí: los clientes viven cacheados en _get_wsdl_client
+    _WSDL_OPS_CACHE[id(client)] = names
+    return names
+
+
+def _build_request_signatures(client) -> dict:
+    """Firmas de entrada de las operaciones de Solicitud.
+
+    `op.input.signature` recorre los tipos compilados del WSDL y es costoso;
+    se calcula una sola vez y el resultado se comparte entre requests.
+    """
+    out: dict = {}
+    try:
+        for svc in client.wsdl.services.values():  # type: ignore[attr-defined]
+            for port in svc.ports.values():  # type: ignore[attr-defined]
+                for name, op in port.binding._operations.items():  # type: ignore[attr-defined]
+                    try:
+                        sig = op.input.signature(client.wsdl.types)  # type: ignore[attr-defined]
+                    except Exception:
+                        try:
+                            sig = str(op)
+                        except Exception:
+                            sig = 'unknown'
+                    out[name] = sig
+                break
+            break
+    except Exception as e:
+        return {'__error__': str(e)}
     return out
 
 
+def _wsdl_client_any(wsdl_url: str):
+    """Prefiere el cliente async (httpx/HTTP2); cae al sync cacheado."""
+    try:
+        return _get_async_wsdl_client(wsdl_url)
+    except Exception:
+        return _get_wsdl_client(wsdl_url)
+
+
 @router.get('/debug/ops')
-def debug_wsdl_operations():
+async def debug_wsdl_operations():
     """Lista las operaciones disponibles en los WSDL de Autenticación y Solicitud.
 
     Útil para confirmar los nombres exactos que expone el SAT y evitar errores de 'No such operation'.
@@ -747,100 +1239,303 @@ def debug_wsdl_operations():
     try:
         ops = {'auth': [], 'request': [], 'request_signatures': {}}  # type: ignore[typeddict-item]
         try:
-            from zeep import Client as _ZeepClient  # type: ignore
             from ..services.sat_sat20 import WSDL_AUTENTICACION, WSDL_SOLICITUD
         except Exception as e:
             return {'error': f'ImportError zeep o constantes WSDL: {e}'}
 
-        # Intentar construir clientes (capturamos errores individuales)
+        # Clientes cacheados: parsear un WSDL implica descargar y compilar
+        # esquemas XSD grandes (cientos de ms); las dos URLs son fijas. La
+        # construcción (bloqueante) va al threadpool para no parar el loop.
         c1 = None
         c2 = None
         try:
-            c1 = _ZeepClient(WSDL_AUTENTICACION)
+            c1 = await run_in_threadpool(_wsdl_client_any, WSDL_AUTENTICACION)
         except Exception as e:
             ops['auth_error'] = str(e)  # type: ignore[index]
         try:
-            c2 = _ZeepClient(WSDL_SOLICITUD)
+            c2 = await run_in_threadpool(_wsdl_client_any, WSDL_SOLICITUD)
         except Exception as e:
             ops['request_error'] = str(e)  # type: ignore[index]
 
-        def _ops(client):
-            if client is None:
-                return []
-            try:
-                for svc in client.wsdl.services.values():  # type: ignore[attr-defined]
-                    for port in svc.ports.values():  # type: ignore[attr-defined]
-                        return sorted(list(port.binding._operations.keys()))  # type: ignore[attr-defined]
-            except Exception:
-                return []
-
         if c1:
-            ops['auth'] = _ops(c1)  # type: ignore[index]
+            ops['auth'] = _wsdl_ops(c1)  # type: ignore[index]
         if c2:
-            ops['request'] = _ops(c2)  # type: ignore[index]
+            ops['request'] = _wsdl_ops(c2)  # type: ignore[index]
 
-        # Firmas de operaciones de solicitud
+        # Firmas de operaciones de solicitud (precalculadas una vez por proceso)
         if c2:
-            try:
-                for svc in c2.wsdl.services.values():  # type: ignore[attr-defined]
-                    for port in svc.ports.values():  # type: ignore[attr-defined]
-                        for name, op in port.binding._operations.items():  # type: ignore[attr-defined]
-                            try:
-                                sig = op.input.signature(c2.wsdl.types)  # type: ignore[attr-defined]
-                            except Exception:
-                                try:
-                                    sig = str(op)
-                                except Exception:
-                                    sig = 'unknown'
-                            ops['request_signatures'][name] = sig  # type: ignore[index]
-                        break
-                    break
-            except Exception as e:
-                ops['signatures_error'] = str(e)  # type: ignore[index]
+            global _REQUEST_SIGNATURES
+            if _REQUEST_SIGNATURES is None:
+                _REQUEST_SIGNATURES = _build_request_signatures(c2)
+            if '__error__' in _REQUEST_SIGNATURES:
+                ops['signatures_error'] = _REQUEST_SIGNATURES['__error__']  # type: ignore[index]
+            else:
+                ops['request_signatures'] = dict(_REQUEST_SIGNATURES)  # type: ignore[index]
         return ops
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 # --- CFDI UTILITIES (separadas de debug_wsdl_operations para registrar en OpenAPI) ---
+# Tipos MIME de los renders cacheables en Storage (render/{uuid}.{formato})
+_RENDER_MEDIA_TYPES = {'pdf': 'application/pdf', 'html': 'text/html'}
+
+
+def _render_response(body: bytes, uuid: str, format: str, gzipped: bool = False) -> Response:
+    """Respuesta de render con cache HTTP: un CFDI timbrado es inmutable,
+    por lo que el UUID sirve directamente de ETag.
+
+    El cuerpo ya está completo en memoria; Response lo envía tal cual sin
+    envolverlo en un BytesIO intermedio como haría StreamingResponse.
+    Con gzipped=True el cuerpo ya viene comprimido y sólo se declara el
+    Content-Encoding (nada de recomprimir por request en middleware).
+    """
+    headers = {
+        'ETag': f'"{uuid}.{format}"',
+        'Cache-Control': 'public, max-age=86400',
+    }
+    if format == 'html':
+        # La representación depende del Accept-Encoding del cliente
+        headers['Vary'] = 'Accept-Encoding'
+    if gzipped:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(
+        content=body,
+        media_type=_RENDER_MEDIA_TYPES[format],
+        headers=headers,
+    )
+
+
+# Pool de procesos para el trabajo CPU-bound de satcfdi (parseo + render +
+# validación criptográfica): corre fuera del proceso del server para no
+# retener el GIL ni congelar el event loop. Las funciones que se le mandan
+# deben ser top-level para que pickle las resuelva en el subproceso.
+_RENDER_POOL = None
+
+
+def _get_render_pool():
+    global _RENDER_POOL
+    if _RENDER_POOL is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _RENDER_POOL = ProcessPoolExecutor(
+            max_workers=int(os.environ.get('SAT_RENDER_WORKERS', '2'))
+        )
+    return _RENDER_POOL
+
+
+@lru_cache(maxsize=1)
+def _get_cfdi_parser():
+    """Parser lxml endurecido, construido una vez por proceso.
+
+    no_network + resolve_entities=False evita que un XML hostil dispare
+    descargas de esquemas o expansión de entidades, y reutilizar el parser
+    ahorra su setup en cada parse. Si SAT_XSD_CACHE_DIR apunta a un
+    directorio con los XSD del SAT, las resoluciones de esquema se sirven
+    de ahí en lugar de salir a red.
+    """
+    from lxml import etree  # type: ignore
+
+    class _LocalXsdResolver(etree.Resolver):
+        def resolve(self, url, public_id, context):
+            cache_dir = os.environ.get('SAT_XSD_CACHE_DIR')
+            if cache_dir and url and url.startswith('http://www.sat.gob.mx/'):
+                path = os.path.join(cache_dir, os.path.basename(url))
+                if os.path.exists(path):
+                    return self.resolve_filename(path, context)
+            return None
+
+    parser = etree.XMLParser(
+        huge_tree=False,
+        load_dtd=False,
+        resolve_entities=False,
+        no_network=True,
+        remove_blank_text=True,
+    )
+    parser.resolvers.add(_LocalXsdResolver())
+    return parser
+
+
+def _parse_cfdi(xml_bytes: bytes):
+    """bytes -> objeto CFDI, preferentemente con el parser del módulo.
+
+    Las versiones de satcfdi que aceptan un árbol lxml usan nuestro parser
+    cacheado; las demás caen a CFDI.from_string (que trae el suyo propio).
+    """
+    from satcfdi.cfdi import CFDI  # type: ignore
+    if hasattr(CFDI, 'from_tree'):
+        try:
+            from lxml import etree  # type: ignore
+            root = etree.fromstring(xml_bytes, _get_cfdi_parser())
+            return CFDI.from_tree(root)  # type: ignore[attr-defined]
+        except Exception:
+            pass
+    return CFDI.from_string(xml_bytes)
+
+
+def _render_cfdi_artifact(xml_bytes: bytes, format: str):
+    """Parsea y renderiza un CFDI (corre en un subproceso del pool).
+
+    Devuelve dict para 'json' y bytes para 'html'/'pdf'. RuntimeError si
+    satcfdi no está instalado (el handler lo traduce a 501).
+    """
+    try:
+        from satcfdi.cfdi import CFDI  # noqa: F401  # type: ignore
+        from satcfdi import render as sat_render  # type: ignore
+    except Exception:
+        raise RuntimeError('satcfdi no disponible para render')
+    cfdi_obj = _parse_cfdi(xml_bytes)
+    if format == 'json':
+        return cfdi_obj.to_dict() if hasattr(cfdi_obj, 'to_dict') else {}  # type: ignore
+    if format == 'html':
+        return sat_render.html_str(cfdi_obj).encode('utf-8')
+    # pdf
+    body = sat_render.pdf_bytes(cfdi_obj) if hasattr(sat_render, 'pdf_bytes') else None
+    if body is None:
+        # pdf_write acepta un objeto archivo: renderizar a memoria
+        # en lugar de un archivo fijo en cwd (que chocaba entre
+        # requests concurrentes y dejaba basura si el proceso moría)
+        try:
+            buf = io.BytesIO()
+            sat_render.pdf_write(cfdi_obj, buf)  # type: ignore
+            body = buf.getvalue()
+        except Exception:
+            import tempfile
+            fd, tmp_path = tempfile.mkstemp(suffix='.pdf')
+            try:
+                os.close(fd)
+                sat_render.pdf_write(cfdi_obj, tmp_path)  # type: ignore
+                with open(tmp_path, 'rb') as fh:
+                    body = fh.read()
+            finally:
+                try:
+                    os.remove(tmp_path)
+                except Exception:
+                    pass
+    return body
+
+
+def _validate_cfdi_bytes(xml_bytes: bytes) -> bool:
+    """Valida firmas y certificados de un CFDI (corre en un subproceso)."""
+    try:
+        from satcfdi.cfdi import CFDI  # noqa: F401  # type: ignore
+        from satcfdi.pacs.sat import SAT  # type: ignore
+    except Exception:
+        raise RuntimeError('satcfdi no disponible para validación')
+    cfdi_obj = _parse_cfdi(xml_bytes)
+    sat = SAT()  # No requiere signer para validate
+    return bool(sat.validate(cfdi_obj))
+
+
+# Si las rutas de Storage siguen una plantilla fija (p.ej. '{uuid}.xml' o
+# 'cfdi/{uuid}.xml'), se puede derivar xml_ref del UUID y ahorrarse el
+# SELECT previo a la tabla cfdi en cada render/validación.
+_XML_REF_TEMPLATE = os.environ.get('CFDI_XML_REF_TEMPLATE')
+
+
+def _cfdi_xml_bytes(sb, bucket: str, uuid: str) -> bytes:
+    """xml_ref de la tabla cfdi -> bytes del XML en Storage (bloqueante)."""
+    if _XML_REF_TEMPLATE:
+        try:
+            blob = sb.storage.from_(bucket).download(_XML_REF_TEMPLATE.format(uuid=uuid))
+            if blob:
+                return blob
+        except Exception:
+            # Ref fuera de plantilla (histórico): cae al camino de dos pasos
+            pass
+    resp = sb.table('cfdi').select('xml_ref').eq('uuid', uuid).maybe_single().execute()
+    data = getattr(resp, 'data', None)
+    if not data or not data.get('xml_ref'):
+        raise HTTPException(status_code=404, detail='CFDI no encontrado')
+    return sb.storage.from_(bucket).download(data['xml_ref'])
+
+
 @router.get('/cfdi/{uuid}/render')
-def render_cfdi(uuid: str, format: str = Query('pdf', pattern='^(pdf|html|json)$')):
+async def render_cfdi(request: Request, uuid: str, format: str = Query('pdf', pattern='^(pdf|html|json)$')):
     """Renderiza un CFDI almacenado (tabla cfdi -> xml_ref -> Storage) usando satcfdi.render.
     Devuelve PDF (application/pdf), HTML (text/html) o JSON estructurado.
     Requiere que la librería satcfdi esté instalada. Si no, responde 501.
+
+    Los renders PDF/HTML se guardan en el bucket bajo render/{uuid}.{formato};
+    renderizar con satcfdi cuesta cientos de ms y el resultado es inmutable.
+    El parseo/render corre en un pool de procesos para no bloquear el loop.
     """
     try:
-        from ..supabase_client import get_supabase
+        # Validador del navegador: el artefacto nunca cambia para un UUID dado
+        if format in _RENDER_MEDIA_TYPES and request.headers.get('if-none-match') == f'"{uuid}.{format}"':
+            return Response(status_code=304)
+        if not _SATCFDI_AVAILABLE:
+            raise HTTPException(status_code=501, detail='satcfdi no disponible para render')
+
         sb = get_supabase()
-        resp = sb.table('cfdi').select('xml_ref').eq('uuid', uuid).maybe_single().execute()
-        data = getattr(resp, 'data', None)
-        if not data or not data.get('xml_ref'):
-            raise HTTPException(status_code=404, detail='CFDI no encontrado')
-        xml_ref = data['xml_ref']
         bucket = os.environ.get('CFDI_BUCKET', 'cfdi-xml')
-        xml_bytes = sb.storage.from_(bucket).download(xml_ref)
-        try:
-            from satcfdi.cfdi import CFDI  # type: ignore
-            from satcfdi import render as sat_render  # type: ignore
-        except Exception:
-            raise HTTPException(status_code=501, detail='satcfdi no disponible para render')
-        cfdi_obj = CFDI.from_string(bytes(xml_bytes))
-        if format == 'json':
-            js = cfdi_obj.to_dict() if hasattr(cfdi_obj, 'to_dict') else {}  # type: ignore
-            return JSONResponse(content=js)
-        elif format == 'html':
-            html_str = sat_render.html_str(cfdi_obj)
-            return StreamingResponse(io.BytesIO(html_str.encode('utf-8')), media_type='text/html')
-        else:  # pdf
-            pdf_bytes = sat_render.pdf_bytes(cfdi_obj) if hasattr(sat_render, 'pdf_bytes') else None
-            if pdf_bytes is None:
-                sat_render.pdf_write(cfdi_obj, 'tmp_cfdi.pdf')  # type: ignore
-                with open('tmp_cfdi.pdf', 'rb') as fh:
-                    pdf_bytes = fh.read()
+        accepts_gzip = 'gzip' in request.headers.get('accept-encoding', '')
+        # El HTML comprime 5-10x y se guarda ya gzipeado; el PDF va tal cual
+        cache_key = f'render/{uuid}.{format}' + ('.gz' if format == 'html' else '')
+
+        # Hit de PDF: 302 a una URL firmada y los bytes fluyen del CDN de
+        # Storage al cliente sin pasar por este proceso (memoria O(1)). El
+        # HEAD previo confirma que el artefacto existe antes de redirigir.
+        # El HTML no se redirige: se sirve gzipeado con Content-Encoding
+        # controlado aquí.
+        if format == 'pdf':
+            def _signed():
                 try:
-                    os.remove('tmp_cfdi.pdf')
+                    signed = sb.storage.from_(bucket).create_signed_url(cache_key, 300)
+                    return signed.get('signedURL') or signed.get('signed_url')
                 except Exception:
-                    pass
-            return StreamingResponse(io.BytesIO(pdf_bytes), media_type='application/pdf')
+                    return None
+            signed_url = await run_in_threadpool(_signed)
+            if signed_url:
+                try:
+                    async with httpx.AsyncClient(timeout=10) as client:
+                        probe = await client.head(signed_url)
+                    if probe.status_code == 200:
+                        return RedirectResponse(signed_url, status_code=302)
+                except Exception:
+                    pass  # Storage inaccesible por HTTP directo: camino normal
+
+        # Cache de artefactos en Storage: hit evita DB, descarga del XML y render
+        if format in _RENDER_MEDIA_TYPES:
+            def _cached():
+                try:
+                    return sb.storage.from_(bucket).download(cache_key)
+                except Exception:
+                    return None
+            cached = await run_in_threadpool(_cached)
+            if cached:
+                if format == 'html' and not accepts_gzip:
+                    return _render_response(gzip.decompress(cached), uuid, format)
+                return _render_response(cached, uuid, format, gzipped=(format == 'html'))
+
+        xml_bytes = await run_in_threadpool(_cfdi_xml_bytes, sb, bucket, uuid)
+        # Storage ya devuelve bytes; copiar con bytes() duplicaría el buffer
+        raw = xml_bytes if isinstance(xml_bytes, (bytes, bytearray)) else bytes(xml_bytes)
+        loop = asyncio.get_running_loop()
+        try:
+            body = await loop.run_in_executor(
+                _get_render_pool(), _render_cfdi_artifact, raw, format
+            )
+        except RuntimeError as e:
+            raise HTTPException(status_code=501, detail=str(e))
+        if format == 'json':
+            return JSONResponse(content=body)
+
+        # Poblar el cache de Storage (best-effort: el render ya está en memoria).
+        # El HTML se comprime una sola vez aquí; los hits lo sirven ya gzipeado.
+        payload = gzip.compress(body, compresslevel=6) if format == 'html' else body
+
+        def _upload():
+            try:
+                sb.storage.from_(bucket).upload(
+                    cache_key,
+                    payload,
+                    file_options={'content-type': _RENDER_MEDIA_TYPES[format], 'upsert': 'true'},
+                )
+            except Exception:
+                pass
+        await run_in_threadpool(_upload)
+        if format == 'html' and accepts_gzip:
+            return _render_response(payload, uuid, format, gzipped=True)
+        return _render_response(body, uuid, format)
     except HTTPException:
         raise
     except Exception as e:
@@ -848,28 +1543,24 @@ def render_cfdi(uuid: str, format: str = Query('pdf', pattern='^(pdf|html|json)$
 
 
 @router.get('/cfdi/{uuid}/validate')
-def validate_cfdi(uuid: str):
+async def validate_cfdi(uuid: str):
     """Valida firmas y certificados del CFDI usando satcfdi SAT.validate().
-    Devuelve { uuid, valid }.
+    Devuelve { uuid, valid }. La validación corre en el pool de procesos.
     """
     try:
-        from ..supabase_client import get_supabase
+        if not _SATCFDI_AVAILABLE:
+            raise HTTPException(status_code=501, detail='satcfdi no disponible para validación')
         sb = get_supabase()
-        resp = sb.table('cfdi').select('xml_ref').eq('uuid', uuid).maybe_single().execute()
-        data = getattr(resp, 'data', None)
-        if not data or not data.get('xml_ref'):
-            raise HTTPException(status_code=404, detail='CFDI no encontrado')
-        xml_ref = data['xml_ref']
         bucket = os.environ.get('CFDI_BUCKET', 'cfdi-xml')
-        xml_bytes = sb.storage.from_(bucket).download(xml_ref)
+        xml_bytes = await run_in_threadpool(_cfdi_xml_bytes, sb, bucket, uuid)
+        raw = xml_bytes if isinstance(xml_bytes, (bytes, bytearray)) else bytes(xml_bytes)
+        loop = asyncio.get_running_loop()
         try:
-            from satcfdi.cfdi import CFDI  # type: ignore
-            from satcfdi.pacs.sat import SAT  # type: ignore
-        except Exception:
-            raise HTTPException(status_code=501, detail='satcfdi no disponible para validación')
-        cfdi_obj = CFDI.from_string(bytes(xml_bytes))
-        sat = SAT()  # No requiere signer para validate
-        valid = sat.validate(cfdi_obj)
+            valid = await loop.run_in_executor(
+                _get_render_pool(), _validate_cfdi_bytes, raw
+            )
+        except RuntimeError as e:
+            raise HTTPException(status_code=501, detail=str(e))
         return { 'uuid': uuid, 'valid': bool(valid) }
     except HTTPException:
         raise
@@ -1,56 +1,206 @@
 # Ejemplo de cómo se invocaría el inicio de una descarga desde una API.
 # Este archivo es el "mesero": rápido y no bloqueante.
 
+import os
+
 from typing import Optional, Dict, Any
-from ..supabase_client import get_supabase
 from .sat_provider import SatProvider, SatKind
 
-class SatJobOrchestrator:
+# Cliente Redis opcional (reutiliza el REDIS_URL del broker Celery). Sirve
+# para deduplicar encolados: sin Redis la funcionalidad simplemente se omite.
+_REDIS_CLIENT = None
+
+
+def _get_redis():
+    global _REDIS_CLIENT
+    if _REDIS_CLIENT is None:
+        try:
+            import redis  # type: ignore
+            from ..celery_app import REDIS_URL
+            if REDIS_URL:
+                _REDIS_CLIENT = redis.Redis.from_url(REDIS_URL)
+        except Exception:
+            return None
+    return _REDIS_CLIENT
+
+
+# Dominio cerrado de `kind`: validar por membresía evita pagar una
+# excepción por cada entrada inválida (p.ej. un frontend mandando basura)
+_VALID_KINDS = frozenset(k.value for k in SatKind)
+
+
+def _enqueue_dedup_key(user_id: str, company_id: str, kind: str,
+                       date_from: Optional[str], date_to: Optional[str]) -> str:
+    return f'sat:enqueue:{user_id}:{company_id}:{kind}:{date_from}:{date_to}'
+
+
+def start_sync_job(
+    user_id: str,
+    company_id: str,
+    kind: str = 'recibidos',
+    date_from: Optional[str] = None,
+    date_to: Optional[str] = None,
+    synchronous: bool = False,
+) -> Dict[str, Any]:
     """
-    Esta clase orquesta el INICIO de los trabajos de sincronización con el SAT.
-    Su única responsabilidad es validar la solicitud y ponerla en una cola de trabajo.
+    Paso 1: Encola un nuevo trabajo de sincronización de CFDI.
+
+    Esta función es la que sería llamada por tu API web. Es muy rápida.
+    1. Valida los parámetros de entrada.
+    2. Llama a `provider.enqueue_sync` para crear un registro en la tabla `sat_jobs`.
+    3. Devuelve inmediatamente el ID del trabajo para que el frontend pueda empezar a monitorear.
+
+    NO ejecuta el proceso de descarga directamente para evitar timeouts,
+    salvo con synchronous=True (o SAT_SYNC_INLINE=1): ahí el job corre
+    inline en este proceso, pensado para tests de integración y jobs
+    chicos en dev sin levantar worker ni broker.
+    Es una función de módulo: el orquestador no guarda estado entre
+    llamadas y construir clientes en un __init__ era trabajo muerto.
     """
-    def __init__(self):
-        self.sb = get_supabase()
-
-    def start_sync_job(
-        self,
-        user_id: str,
-        company_id: str,
-        kind: str = 'recibidos',
-        date_from: Optional[str] = None,
-        date_to: Optional[str] = None,
-    ) -> Dict[str, Any]:
-        """
-        Paso 1: Encola un nuevo trabajo de sincronización de CFDI.
-
-        Esta función es la que sería llamada por tu API web. Es muy rápida.
-        1. Valida los parámetros de entrada.
-        2. Llama a `provider.enqueue_sync` para crear un registro en la tabla `sat_jobs`.
-        3. Devuelve inmediatamente el ID del trabajo para que el frontend pueda empezar a monitorear.
-        
-        NO ejecuta el proceso de descarga directamente para evitar timeouts.
-        """
-        # Validación de tipo
+    # Validación de tipo: membresía primero, enum sólo en el camino feliz
+    if kind not in _VALID_KINDS:
+        raise ValueError("kind debe ser 'recibidos' o 'emitidos'")
+    k = SatKind(kind)
+
+    provider = SatProvider()
+
+    # 0) Dedup con Redis (SET NX): un doble clic en "Sincronizar" no debe
+    # encolar dos jobs idénticos contra el SAT. Sin Redis se omite.
+    dedup_key = _enqueue_dedup_key(user_id, company_id, kind, date_from, date_to)
+    r = _get_redis()
+    if r is not None:
         try:
-            k = SatKind(kind)
+            if not r.set(dedup_key, 'pending', nx=True, ex=60):
+                existing = r.get(dedup_key + ':job_id')
+                if existing:
+                    return {
+                        'message': 'Job already in progress.',
+                        'job_id': existing.decode(),
+                        'deduplicated': True,
+                    }
         except Exception:
-            raise ValueError("kind debe ser 'recibidos' o 'emitidos'")
-
-        provider = SatProvider()
-        
-        # 1) Encolar el job (esto valida perfil/firma si no está en DEMO y es muy rápido)
-        job_id = provider.enqueue_sync(
-            user_id=user_id,
-            company_id=company_id,
-            kind=k,
-            date_from=date_from,
-            date_to=date_to,
-        )
-
-        # 2) Devolver el ID del job para que el frontend pueda monitorear su estado.
-        # El procesamiento real lo hará un 'worker' en segundo plano.
+            r = None  # Redis caído: seguir sin dedup
+
+    # 1) Encolar el job (esto valida perfil/firma si no está en DEMO y es muy rápido)
+    job_id = provider.enqueue_sync(
+        user_id=user_id,
+        company_id=company_id,
+        kind=k,
+        date_from=date_from,
+        date_to=date_to,
+    )
+
+    # 1.5) Camino síncrono: procesar el job aquí mismo y devolver el
+    # resultado, saltando broker y worker (RTT + prefetch que en tests
+    # domina el tiempo total). La passphrase sale del entorno, igual que
+    # en services/worker.py.
+    if synchronous or os.environ.get('SAT_SYNC_INLINE') == '1':
+        try:
+            provider.process_job(
+                job_id=job_id,
+                user_id=user_id,
+                company_id=company_id,
+                kind=k,
+                date_from=date_from,
+                date_to=date_to,
+                passphrase=os.environ.get('DEFAULT_EFIRMA_PASSPHRAS_E'),
+            )
+        finally:
+            if r is not None:
+                try:
+                    r.delete(dedup_key, dedup_key + ':job_id')
+                except Exception:
+                    pass
         return {
-            'message': 'Job enqueued successfully.',
+            'message': 'Job executed inline.',
             'job_id': job_id,
+            'inline': True,
         }
+
+    # 2) Si hay broker Redis configurado, despachar por Celery: el worker
+    # recibe el job al instante (BRPOP) en lugar de descubrirlo en el
+    # siguiente ciclo de polling sobre sat_jobs.
+    out: Dict[str, Any] = {
+        'message': 'Job enqueued successfully.',
+        'job_id': job_id,
+    }
+    if r is not None:
+        try:
+            # Reencolados dentro de la hora devuelven este job_id; la clave
+            # exterior expira sola (60 s) o la borra el worker al terminar
+            r.setex(dedup_key + ':job_id', 3600, job_id)
+        except Exception:
+            pass
+    try:
+        from .sat_tasks import run_sync_job
+        if run_sync_job is not None:
+            # Cola por tipo: recibidos (I/O-bound) y emitidos (CPU-bound)
+            # corren en pools de worker dimensionados distinto.
+            queue = 'sat_recibidos' if k is SatKind.recibidos else 'sat_emitidos'
+            # time_limit por debajo del visibility timeout del broker (6 h):
+            # un job colgado muere antes de que Redis lo redelivery-e
+            result = run_sync_job.apply_async(
+                args=[job_id], queue=queue, routing_key=queue,
+                soft_time_limit=5 * 3600, time_limit=6 * 3600,
+            )
+            out['task_id'] = result.id
+            out['queue'] = queue
+    except Exception:
+        # Sin broker (o caído): el worker de polling procesará el job igual
+        pass
+
+    # 3) Devolver el ID del job para que el frontend pueda monitorear su estado.
+    return out
+
+
+def start_backfill(
+    user_id: str,
+    company_id: str,
+    kind: str = 'recibidos',
+    from_year: int = 2020,
+    to_year: int = 2020,
+) -> Dict[str, Any]:
+    """Encola un job de sincronización por cada mes de [from_year, to_year].
+
+    El despacho al broker va en un solo group() de Celery (Redis lo
+    pipelinea: un round-trip para las N tareas, no N), con los payloads
+    comprimidos por task_compression. Sin broker, los jobs quedan en
+    sat_jobs y el worker de polling los toma igual.
+    """
+    import calendar
+
+    if kind not in _VALID_KINDS:
+        raise ValueError("kind debe ser 'recibidos' o 'emitidos'")
+    k = SatKind(kind)
+    provider = SatProvider()
+
+    # Un insert por mes vía enqueue_sync: mantiene la validación de
+    # perfil/firma del camino normal (un bulk insert directo la saltaría)
+    job_ids = []
+    for year in range(from_year, to_year + 1):
+        for month in range(1, 13):
+            last_day = calendar.monthrange(year, month)[1]
+            job_ids.append(provider.enqueue_sync(
+                user_id=user_id,
+                company_id=company_id,
+                kind=k,
+                date_from=f'{year:04d}-{month:02d}-01',
+                date_to=f'{year:04d}-{month:02d}-{last_day:02d}',
+            ))
+
+    out: Dict[str, Any] = {'job_ids': job_ids, 'count': len(job_ids)}
+    try:
+        from celery import group  # type: ignore
+        from .sat_tasks import run_sync_job
+        if run_sync_job is not None:
+            queue = 'sat_recibidos' if k is SatKind.recibidos else 'sat_emitidos'
+            group(
+                run_sync_job.s(jid).set(queue=queue, routing_key=queue)
+                for jid in job_ids
+            ).apply_async()
+            out['dispatched'] = True
+            out['queue'] = queue
+    except Exception:
+        # Sin broker (o caído): el worker de polling procesará los jobs igual
+        pass
+    return out
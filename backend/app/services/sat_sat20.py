@@ -2,7 +2,7 @@ import os
 import uuid
 import tempfile
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterator
 import time
 import base64
 import zipfile
@@ -55,6 +55,24 @@ WSDL_VERIFICACION = "https://cfdidescargamasivaconsultas.clouda.sat.gob.mx/Verif
 WSDL_DESCARGA = "https://cfdidescargamasivadescarga.clouda.sat.gob.mx/DescargarService.svc?wsdl"
 
 
+def _effective_env(overrides: Optional[Dict[str, Optional[str]]]):
+    """Vista del entorno para una llamada concreta.
+
+    Aplica overrides sobre una copia (valor None = variable ausente) sin mutar
+    os.environ: dos requests concurrentes no se pisan sus banderas SAT_* y el
+    camino caliente evita escrituras al entorno del proceso.
+    """
+    if not overrides:
+        return os.environ
+    env = dict(os.environ)
+    for k, v in overrides.items():
+        if v is None:
+            env.pop(k, None)
+        else:
+            env[k] = v
+    return env
+
+
 class Sat20Client:
     """
     Cliente para el servicio de Descarga Masiva de CFDI 2.0 del SAT.
@@ -73,8 +91,14 @@ class Sat20Client:
         self._satcfdi_requests: Dict[str, Any] = {}
         self._satcfdi_last_instance: Optional[Any] = None
 
-    def authenticate(self, cer_bytes: bytes, key_bytes: bytes, passphrase: Optional[str]) -> str:
-        """Autenticación contra SAT 2.0 para obtener un token de acceso."""
+    def authenticate(self, cer_bytes: bytes, key_bytes: bytes, passphrase: Optional[str],
+                     overrides: Optional[Dict[str, Optional[str]]] = None) -> str:
+        """Autenticación contra SAT 2.0 para obtener un token de acceso.
+
+        `overrides` permite ajustar banderas SAT_* sólo para esta llamada sin
+        tocar os.environ (ver _effective_env).
+        """
+        env = _effective_env(overrides)
         if ZeepClient is None or Signature is None:
             raise RuntimeError('Dependencias SOAP no disponibles (zeep). Instala con `pip install zeep`.')
         if not XMLSEC_AVAILABLE:
@@ -145,7 +169,7 @@ class Sat20Client:
                 key_der = None  # type: ignore
 
             # Opción 1: usar la librería SAT-CFDI si está habilitada y disponible
-            if os.environ.get('SAT_USE_SATCFDI', '0').lower() in ('1','true','yes'):
+            if env.get('SAT_USE_SATCFDI', '0').lower() in ('1','true','yes'):
                 try:
                     token_lib = self._satcfdi_authenticate(cert_der, key_der, passphrase)
                     if token_lib:
@@ -155,8 +179,8 @@ class Sat20Client:
                         print(f"[SAT_AUTH][SATCFDI][WARN] {e}")
 
             # Fallback manual opcional: construir y firmar SOAP sin Zeep/WSSE
-            if os.environ.get('SAT_MANUAL_AUTH', '0').lower() in ('1','true','yes'):
-                return self._manual_authenticate(cert_der, key_pem)
+            if env.get('SAT_MANUAL_AUTH', '0').lower() in ('1','true','yes'):
+                return self._manual_authenticate(cert_der, key_pem, overrides=overrides)
 
             # Subclase para omitir verificación de firma en la respuesta SOAP (algunos WSDL devuelven
             # headers que provocan SignatureVerificationFailed aunque la Autentica sea correcta).
@@ -172,7 +196,7 @@ class Sat20Client:
                 {'label': 'rsa-sha1', 'sig': Transform.RSA_SHA1, 'dig': Transform.SHA1},
                 {'label': 'rsa-sha256', 'sig': Transform.RSA_SHA256, 'dig': Transform.SHA256},
             ]
-            force_alg = os.environ.get('SAT_FORCE_ALG', '').lower().strip()
+            force_alg = env.get('SAT_FORCE_ALG', '').lower().strip()
             if force_alg:
                 alg_options = [a for a in alg_options_all if a['label'] == force_alg]
                 if not alg_options:
@@ -218,7 +242,7 @@ class Sat20Client:
 
                     # Plugin para inyectar BinarySecurityToken + SecurityTokenReference (algunos endpoints SAT lo requieren)
                     # Activable con SAT_WSSE_BST=1 (por defecto lo activamos para aumentar compatibilidad)
-                    inject_bst = os.environ.get('SAT_WSSE_BST', '1').lower() not in ('0','false','no')
+                    inject_bst = env.get('SAT_WSSE_BST', '1').lower() not in ('0','false','no')
                     bst_id = f"BST-{uuid.uuid4()}"
                     bst_plugin = None
                     if inject_bst:
@@ -435,10 +459,10 @@ class Sat20Client:
                 last_str = str(last_err) or repr(last_err)
                 # Intentar fallback manual automáticamente si no se pidió explícitamente
                 try:
-                    if os.environ.get('SAT_MANUAL_AUTH', '0').lower() not in ('1','true','yes'):
+                    if env.get('SAT_MANUAL_AUTH', '0').lower() not in ('1','true','yes'):
                         if debug:
                             print('[SAT_AUTH][FALLBACK] Intentando modo manual (sin Zeep/wsse).')
-                        token_fb = self._manual_authenticate(cert_der, key_pem)
+                        token_fb = self._manual_authenticate(cert_der, key_pem, overrides=overrides)
                         return token_fb
                 except Exception as fe:
                     if debug:
@@ -447,7 +471,8 @@ class Sat20Client:
                 raise RuntimeError(f'Error en la llamada de autenticación al SAT (último intento): {last_str}{extra}')
             raise RuntimeError('No fue posible autenticarse con el SAT por causa desconocida.')
 
-    def _manual_authenticate(self, cert_der: bytes, key_pem: bytes) -> str:
+    def _manual_authenticate(self, cert_der: bytes, key_pem: bytes,
+                             overrides: Optional[Dict[str, Optional[str]]] = None) -> str:
         """Autenticación manual: construye y firma un SOAP 1.1 con XMLDSig y lo envía via requests.
 
         Útil en Windows cuando Zeep+xmlsec presentan errores. Requiere xmlsec y requests.
@@ -456,9 +481,10 @@ class Sat20Client:
         from lxml import etree  # type: ignore
         import xmlsec  # type: ignore
 
+        env = _effective_env(overrides)
         debug = os.environ.get('SAT_DEBUG', '0').lower() in ('1','true','yes')
-        alg = os.environ.get('SAT_FORCE_ALG', 'rsa-sha1').lower().strip() or 'rsa-sha1'
-        dig_env = os.environ.get('SAT_FORCE_DIGEST', '').lower().strip()
+        alg = env.get('SAT_FORCE_ALG', 'rsa-sha1').lower().strip() or 'rsa-sha1'
+        dig_env = env.get('SAT_FORCE_DIGEST', '').lower().strip()
 
         # Selección de métodos de firma/digest (vía getattr para evitar warnings de tipos)
         Transform = getattr(xmlsec, 'Transform')
@@ -769,14 +795,17 @@ class Sat20Client:
         cer_bytes: Optional[bytes] = None,
         key_bytes: Optional[bytes] = None,
         key_passphrase: Optional[str] = None,
+        overrides: Optional[Dict[str, Optional[str]]] = None,
     ) -> str:
         """Crea una solicitud de descarga y retorna un request_id.
 
         Usa el tipo complejo correcto del WSDL (nsX:SolicitudDescargaMasivaTercero[Recibidos|Emitidos])
         para evitar errores de deserialización en servicios WCF.
+        `overrides` ajusta banderas SAT_* sólo para esta llamada (ver _effective_env).
         """
+        env = _effective_env(overrides)
         # Si se habilita modo FULL SAT-CFDI, delegar solicitud a la librería
-        if os.environ.get('SAT_USE_SATCFDI_FULL','0').lower() in ('1','true','yes') and cer_bytes and key_bytes:
+        if env.get('SAT_USE_SATCFDI_FULL','0').lower() in ('1','true','yes') and cer_bytes and key_bytes:
             try:
                 from . import satcfdi_adapter
                 import hashlib
@@ -863,7 +892,7 @@ class Sat20Client:
         tipo_comp = (tipo_comprobante_override or os.environ.get('SAT_TIPO_COMPROBANTE', '')).strip().upper()
 
         # Si se indica modo manual (o hay material de firma), usar SOAP 1.1 manual para evitar 415
-        if os.environ.get('SAT_SOLICITUD_MANUAL', '1').lower() in ('1','true','yes'):
+        if env.get('SAT_SOLICITUD_MANUAL', '1').lower() in ('1','true','yes'):
             return self._manual_request_download(
                 token=token,
                 rfc=rfc,
@@ -960,9 +989,8 @@ class Sat20Client:
                     Key = getattr(ds, 'Key')
                     KeyFormat = getattr(ds, 'KeyFormat')
                     # Selección de algoritmos (SATCFDI usa sha1 en solicitud)
-                    import os as _os_local
-                    alg = (_os_local.environ.get('SAT_FORCE_ALG') or 'rsa-sha1').lower()
-                    dig = (_os_local.environ.get('SAT_FORCE_DIGEST') or 'sha1').lower()
+                    alg = (env.get('SAT_FORCE_ALG') or 'rsa-sha1').lower()
+                    dig = (env.get('SAT_FORCE_DIGEST') or 'sha1').lower()
                     sig_method = Transform.RSA_SHA1 if alg == 'rsa-sha1' else Transform.RSA_SHA256
                     dig_method = Transform.SHA1 if dig == 'sha1' else Transform.SHA256
 
@@ -1367,6 +1395,19 @@ class Sat20Client:
             
         raise RuntimeError(f'Timeout esperando paquetes del SAT para la solicitud {request_id}.')
 
+    def iter_ready_packages(self, token: str, request_id: str) -> Iterator[str]:
+        """Genera los IDs de paquetes conforme están listos para descargar.
+
+        El servicio de verificación del SAT entrega hoy todos los
+        IdsPaquetes en el mismo mensaje con el que la solicitud pasa a
+        Terminada, así que este generador agota wait_and_list_packages y
+        los emite uno a uno. Es la costura de pipelining: el consumidor
+        puede ir despachando descargas según recibe IDs, y si el SAT
+        algún día reporta paquetes de forma incremental sólo hay que
+        cambiar esta función.
+        """
+        yield from self.wait_and_list_packages(token, request_id)
+
     def download_package_xmls(self, token: str, package_id: str) -> List[Dict[str, Any]]:
         """Descarga un paquete ZIP, lo descomprime y extrae la información de los XMLs."""
         if os.environ.get('SAT_USE_SATCFDI_FULL','0').lower() in ('1','true','yes'):
@@ -1436,7 +1477,9 @@ class Sat20Client:
                 items.append({
                     'uuid': uid, 'fecha': fecha, 'subtotal': subtotal, 'iva': round(iva, 2) if iva else None,
                     'total': total, 'tipo': tipo, 'emisor_rfc': emisor_rfc, 'receptor_rfc': receptor_rfc,
-                    'content': text,
+                    # bytes originales del ZIP: evita que el decode de arriba
+                    # (sólo necesario para los regex) viaje como copia extra
+                    'content': xml_bytes,
                 })
             except Exception:
                 continue
@@ -0,0 +1,107 @@
+"""Tareas Celery para la sincronización SAT.
+
+Sólo se registran si hay broker configurado (ver celery_app.py). La tarea
+recibe únicamente el job_id primitivo: el worker relee la fila de sat_jobs
+desde Supabase, así el payload del broker se mantiene mínimo y serializable.
+
+Errores transitorios (SOAP/HTTP/conexión) reintentan solos con backoff
+exponencial y jitter; los fallos definitivos se publican en la lista Redis
+`sat_sync_dlq` para inspección y reencolado manual (ver /sat/jobs/dlq).
+"""
+import json
+import os
+
+from ..celery_app import celery_app
+
+# Excepciones que ameritan reintento automático: caídas de red o del SAT.
+# Los imports son opcionales, igual que las librerías que los definen.
+_RETRYABLE: tuple = (ConnectionError, TimeoutError)
+try:
+    from zeep.exceptions import Fault as _ZeepFault  # type: ignore
+    _RETRYABLE += (_ZeepFault,)
+except Exception:  # pragma: no cover
+    pass
+try:
+    import httpx as _httpx  # type: ignore
+    _RETRYABLE += (_httpx.HTTPError,)
+except Exception:  # pragma: no cover
+    pass
+
+DLQ_KEY = 'sat_sync_dlq'
+
+run_sync_job = None
+
+if celery_app is not None:
+
+    class _SyncTask(celery_app.Task):  # type: ignore[misc]
+        """Tarea con dead-letter queue: agotar reintentos no pierde el job."""
+
+        def on_failure(self, exc, task_id, args, kwargs, einfo):
+            try:
+                from .sat_job_example import _get_redis
+                r = _get_redis()
+                if r is not None:
+                    r.lpush(DLQ_KEY, json.dumps({
+                        'task_id': task_id,
+                        'args': list(args or ()),
+                        'error': str(exc),
+                        'traceback': getattr(einfo, 'traceback', None),
+                    }))
+            except Exception:
+                pass
+
+    @celery_app.task(
+        name='sat.sync',
+        base=_SyncTask,
+        bind=True,
+        acks_late=True,
+        autoretry_for=_RETRYABLE,
+        retry_backoff=2,
+        retry_backoff_max=600,
+        retry_jitter=True,
+        max_retries=8,
+    )
+    def run_sync_job(self, job_id: str):  # type: ignore[misc]
+        from ..supabase_client import get_supabase
+        from .sat_provider import SatProvider, SatKind
+
+        sb = get_supabase()
+        resp = sb.table('sat_jobs').select('*').eq('id', job_id).maybe_single().execute()
+        job = getattr(resp, 'data', None)
+        if not job:
+            return {'job_id': job_id, 'error': 'job no encontrado'}
+
+        # Igual que services/worker.py: la passphrase no viaja por el broker
+        passphrase = os.environ.get('DEFAULT_EFIRMA_PASSPHRAS_E')
+        provider = SatProvider()
+        # Meta visible vía GET /sat/tasks/{task_id}/status sin tocar Supabase
+        try:
+            self.update_state(state='PROGRESS', meta={'job_id': job_id, 'stage': 'processing'})
+        except Exception:
+            pass
+        # Sin try/except: las excepciones transitorias (_RETRYABLE) reintentan
+        # solas con backoff+jitter y el resto cae a la DLQ vía on_failure;
+        # process_job ya dejó el error marcado en sat_jobs en ambos casos.
+        provider.process_job(
+            job_id=job['id'],
+            user_id=job['user_id'],
+            company_id=job['company_id'],
+            kind=SatKind(job['kind']),
+            date_from=job.get('date_from'),
+            date_to=job.get('date_to'),
+            passphrase=passphrase,
+        )
+        # Job terminado: liberar las llaves de dedup de encolado para que una
+        # nueva sincronización del mismo rango pueda entrar de inmediato
+        try:
+            from .sat_job_example import _get_redis, _enqueue_dedup_key
+            r = _get_redis()
+            if r is not None:
+                key = _enqueue_dedup_key(
+                    job['user_id'], job['company_id'], job['kind'],
+                    job.get('date_from'), job.get('date_to'),
+                )
+                r.delete(key, key + ':job_id')
+        except Exception:
+            pass
+        return {'job_id': job_id, 'status': 'done'}
@@ -178,7 +178,7 @@ def parse_zip_cfdis(b64data: str) -> List[Dict[str, Any]]:
                 'tipo': tipo[:1],
                 'emisor_rfc': emisor_rfc,
                 'receptor_rfc': receptor_rfc,
-                'content': xml_bytes.decode('utf-8', errors='ignore'),
+                'content': xml_bytes,
             })
         except Exception:
             # fallback a heurística simple
@@ -196,6 +196,6 @@ def parse_zip_cfdis(b64data: str) -> List[Dict[str, Any]]:
             items.append({
                 'uuid': uuid or '', 'fecha': fecha, 'subtotal': subtotal, 'iva': None,
                 'total': total, 'tipo': tipo, 'emisor_rfc': emisor, 'receptor_rfc': receptor,
-                'content': text,
+                'content': xml_bytes,
             })
     return items
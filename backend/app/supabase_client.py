@@ -1,17 +1,17 @@
 import os
-from typing import Optional
+from functools import lru_cache
 from supabase import create_client, Client
 
-# Python 3.9 compat: usar Optional en lugar de operador '|'
-_supabase: Optional[Client] = None
 
+@lru_cache(maxsize=1)
 def get_supabase() -> Client:
-    global _supabase
-    if _supabase is None:
-        url = os.environ.get('SUPABASE_URL')
-        key = os.environ.get('SUPABASE_SERVICE_ROLE')
-        if not url or not key:
-            raise RuntimeError('Faltan SUPABASE_URL o SUPABASE_SERVICE_ROLE en el entorno')
-        _supabase = create_client(url, key)
-    # para el tipo, mypy/linters pueden requerir aserción
-    return _supabase  # type: ignore[return-value]
+    """Cliente único por proceso.
+
+    Reutilizarlo entre requests amortiza el handshake TLS y la carga de certificados
+    raíz del pool httpx interno en lugar de pagarlos por llamada.
+    """
+    url = os.environ.get('SUPABASE_URL')
+    key = os.environ.get('SUPABASE_SERVICE_ROLE')
+    if not url or not key:
+        raise RuntimeError('Faltan SUPABASE_URL o SUPABASE_SERVICE_ROLE en el entorno')
+    return create_client(url, key)
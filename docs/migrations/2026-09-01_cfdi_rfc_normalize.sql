@@ -0,0 +1,12 @@
+-- Normaliza los RFC de cfdi a mayúsculas en la base para que la ruta de lectura
+-- (/reports/monthly) no tenga que hacer upper() por fila en cada request.
+-- Ejecutar en el editor SQL de Supabase.
+
+update cfdi
+set emisor_rfc = upper(emisor_rfc),
+    receptor_rfc = upper(receptor_rfc)
+where emisor_rfc <> upper(emisor_rfc)
+   or receptor_rfc <> upper(receptor_rfc);
+
+alter table cfdi add constraint cfdi_rfc_upper_check
+    check (emisor_rfc = upper(emisor_rfc) and receptor_rfc = upper(receptor_rfc));
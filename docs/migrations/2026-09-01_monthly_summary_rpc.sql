@@ -0,0 +1,32 @@
+-- Función de agregación mensual para /reports/monthly: el GROUP BY corre en Postgres
+-- y al backend sólo viajan ~N_meses filas en lugar de todos los CFDI de la compañía.
+-- Ejecutar en el editor SQL de Supabase.
+
+create or replace function monthly_summary(p_company uuid)
+returns table (
+    ym text,
+    ingresos numeric,
+    egresos numeric,
+    iva_cobrado numeric,
+    iva_acreditable numeric
+)
+language sql
+stable
+as $$
+    select
+        substr(cfdi.fecha::text, 1, 7) as ym,
+        coalesce(sum(cfdi.total)            filter (where upper(cfdi.emisor_rfc)   = upper(c.rfc)), 0) as ingresos,
+        coalesce(sum(cfdi.total)            filter (where upper(cfdi.receptor_rfc) = upper(c.rfc)), 0) as egresos,
+        coalesce(sum(coalesce(cfdi.impuestos, round(cfdi.total * 0.16, 2)))
+                                            filter (where upper(cfdi.emisor_rfc)   = upper(c.rfc)), 0) as iva_cobrado,
+        coalesce(sum(coalesce(cfdi.impuestos, round(cfdi.total * 0.16, 2)))
+                                            filter (where upper(cfdi.receptor_rfc) = upper(c.rfc)), 0) as iva_acreditable
+    from cfdi
+    join companies c on c.id = cfdi.company_id
+    where cfdi.company_id = p_company
+    group by ym
+    order by ym;
+$$;
+
+-- Índice para que el filtro por compañía + agrupación mensual no barra toda la tabla
+create index if not exists cfdi_company_fecha_idx on cfdi(company_id, fecha);
@@ -0,0 +1,17 @@
+-- Sondeo de existencia de tablas para /sat/self-check en un solo round-trip.
+-- Antes el backend hacía un select('*').limit(1) por tabla (5 RTTs y filas
+-- completas copiadas sólo para probar que la tabla existe).
+create or replace function sat_self_check_tables(names text[])
+returns jsonb
+language sql
+stable
+as $$
+  select jsonb_object_agg(
+    t,
+    exists (
+      select 1 from information_schema.tables
+      where table_schema = 'public' and table_name = t
+    )
+  )
+  from unnest(names) as t;
+$$;
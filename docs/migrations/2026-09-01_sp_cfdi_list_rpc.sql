@@ -0,0 +1,38 @@
+-- Función RPC para /sat/cfdi/list: una sola consulta preparada en lugar de la
+-- cadena variable de filtros eq/gte/lte que PostgREST genera (y Postgres
+-- re-planea) distinta en cada combinación de parámetros.
+-- El índice (company_id, fecha desc) da el orden del listado sin sort.
+-- Ejecutar en el editor SQL de Supabase.
+
+create index if not exists cfdi_company_fecha_desc_idx on cfdi(company_id, fecha desc);
+
+create or replace function sp_cfdi_list(
+    p_company uuid,
+    p_uuid text default null,
+    p_tipo text default null,
+    p_from date default null,
+    p_to date default null,
+    p_limit int default 10,
+    p_offset int default 0
+)
+returns table (
+    uuid text,
+    fecha date,
+    emisor_rfc text,
+    receptor_rfc text,
+    total numeric,
+    tipo text
+)
+language sql
+stable
+as $$
+    select c.uuid, c.fecha, c.emisor_rfc, c.receptor_rfc, c.total, c.tipo
+    from cfdi c
+    where c.company_id = p_company
+      and (p_uuid is null or c.uuid = p_uuid)
+      and (p_tipo is null or c.tipo = p_tipo)
+      and (p_from is null or c.fecha >= p_from)
+      and (p_to is null or c.fecha <= p_to)
+    order by c.fecha desc
+    limit p_limit offset p_offset;
+$$;
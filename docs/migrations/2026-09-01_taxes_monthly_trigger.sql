@@ -0,0 +1,66 @@
+-- Mantiene taxes_monthly de forma incremental con un trigger sobre cfdi para que
+-- /reports/monthly sea un SELECT directo (O(meses)) en lugar de recalcular desde
+-- los CFDI crudos en cada visita al dashboard.
+-- Requiere: 2026-09-01_taxes_monthly_upsert_index.sql
+-- Ejecutar en el editor SQL de Supabase.
+
+alter table taxes_monthly add column if not exists ingresos numeric;
+alter table taxes_monthly add column if not exists egresos numeric;
+
+-- Recalcula el bucket de un solo mes para una compañía (barato: sólo ese rango de fechas)
+create or replace function taxes_monthly_refresh_month(p_company uuid, p_periodo date)
+returns void
+language sql
+as $$
+    insert into taxes_monthly as tm (company_id, periodo, ingresos, egresos, iva_cobrado, iva_acreditable, iva_a_pagar, isr_base)
+    select
+        p_company,
+        p_periodo,
+        coalesce(sum(b.total) filter (where b.es_emisor), 0),
+        coalesce(sum(b.total) filter (where b.es_receptor), 0),
+        coalesce(sum(b.iva) filter (where b.es_emisor), 0),
+        coalesce(sum(b.iva) filter (where b.es_receptor), 0),
+        round(coalesce(sum(b.iva) filter (where b.es_emisor), 0)
+            - coalesce(sum(b.iva) filter (where b.es_receptor), 0), 2),
+        greatest(coalesce(sum(b.total) filter (where b.es_emisor), 0)
+            - coalesce(sum(b.total) filter (where b.es_receptor), 0), 0)
+    from (
+        select
+            cfdi.total,
+            coalesce(cfdi.impuestos, round(cfdi.total * 0.16, 2)) as iva,
+            upper(cfdi.emisor_rfc)   = upper(c.rfc) as es_emisor,
+            upper(cfdi.receptor_rfc) = upper(c.rfc) as es_receptor
+        from cfdi
+        join companies c on c.id = cfdi.company_id
+        where cfdi.company_id = p_company
+          and cfdi.fecha >= p_periodo
+          and cfdi.fecha < (p_periodo + interval '1 month')
+    ) b
+    on conflict (company_id, periodo) do update set
+        ingresos = excluded.ingresos,
+        egresos = excluded.egresos,
+        iva_cobrado = excluded.iva_cobrado,
+        iva_acreditable = excluded.iva_acreditable,
+        iva_a_pagar = excluded.iva_a_pagar,
+        isr_base = excluded.isr_base;
+$$;
+
+create or replace function taxes_monthly_on_cfdi_change()
+returns trigger
+language plpgsql
+as $$
+begin
+    if tg_op in ('INSERT', 'UPDATE') and new.fecha is not null then
+        perform taxes_monthly_refresh_month(new.company_id, date_trunc('month', new.fecha)::date);
+    end if;
+    if tg_op in ('UPDATE', 'DELETE') and old.fecha is not null then
+        perform taxes_monthly_refresh_month(old.company_id, date_trunc('month', old.fecha)::date);
+    end if;
+    return null;
+end;
+$$;
+
+drop trigger if exists cfdi_taxes_monthly_refresh on cfdi;
+create trigger cfdi_taxes_monthly_refresh
+after insert or update or delete on cfdi
+for each row execute function taxes_monthly_on_cfdi_change();
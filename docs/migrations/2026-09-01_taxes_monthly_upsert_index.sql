@@ -0,0 +1,5 @@
+-- Índice único requerido por el upsert batched de /reports/monthly (persist=true)
+-- Ejecutar en el editor SQL de Supabase antes de desplegar el backend actualizado
+
+create unique index if not exists taxes_monthly_company_periodo_key
+    on taxes_monthly(company_id, periodo);